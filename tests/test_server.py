@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from watcher import stats
+from watcher.bench import create_repo, query, start_server, stop_server
+from watcher.client import Connection
+from watcher.constants import local_socket_address
+
+
+class TestServeMsg(unittest.TestCase):
+
+    def test_unknown_queries(self):
+        from watcher.server import serve_msg
+        for q in (['x'], {'a': 1}, 'nonexistent'):
+            self.assertFalse(serve_msg({'q': q})['ok'])
+        self.assertIn('query:unknown', stats.latencies)
+        self.assertTrue(serve_msg({'q': 'stats'})['ok'])
+        self.assertIn('query:stats', stats.latencies)
+
+
+class TestServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.base = os.path.realpath(tempfile.mkdtemp())
+        cls.pid, cls.address = start_server()
+        cls.previous_address = getattr(local_socket_address, 'ADDRESS', None)
+        local_socket_address.ADDRESS = cls.address
+
+    @classmethod
+    def tearDownClass(cls):
+        local_socket_address.ADDRESS = cls.previous_address
+        stop_server(cls.pid)
+        shutil.rmtree(cls.base, ignore_errors=True)
+
+    def assert_alive(self):
+        self.assertTrue(query(self.address, {'q': 'stats'})['ok'])
+
+    def test_malformed_messages(self):
+        ' Messages that are not JSON objects or have unexpected values must not kill the server '
+        bad = ([1, 2], 'x', 1, None, {'q': ['x']}, {'q': {'a': 1}}, {'q': 'vcs', 'path': [1]})
+        for msg in bad:
+            ans = query(self.address, msg)
+            self.assertFalse(ans['ok'], msg)
+            self.assert_alive()
+        c = Connection()
+        try:
+            for msg in bad + ({'q': 'subscribe', 'topics': [[1]]}, {'q': 'unsubscribe', 'topics': {'a': 1}}):
+                self.assertFalse(c(msg)['ok'], msg)
+            self.assertTrue(c({'q': 'stats'})['ok'])
+        finally:
+            c.close()
+        self.assert_alive()
+
+    def test_garbage(self):
+        ' Clients that send garbage are disconnected, without affecting other clients '
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with s:
+            s.connect(self.address)
+            s.sendall(b'\x01{not json')
+            s.shutdown(socket.SHUT_WR)
+            self.assertEqual(s.recv(100), b'')
+        self.assert_alive()
+
+    def test_async_prompt(self):
+        ' The right prompt is sent at once without VCS data, followed by the full prompt, if that is not ready '
+        repo = create_repo(self.base, 10, 3, 0)[0]
+        plain = os.path.join(self.base, 'plain')
+        os.mkdir(plain)
+        c = Connection()
+
+        def prompt(cwd, lines=None):
+            ' Send a prompt query, reading as many lines as are expected '
+            request_id = c.send({'q': 'prompt', 'which': 'right', 'async': '1', 'cwd': cwd})
+            ans = [c.recv(request_id, ds=bytes)]
+            if lines == 2 or (lines is None and b'master' not in ans[0]):
+                ans.append(c.recv(request_id, ds=bytes))
+            # Responses are queued in the order they are ready, so no more
+            # lines are coming, if there are none before this reply
+            self.assertTrue(c({'q': 'stats'})['ok'])
+            self.assertNotIn(request_id, c.responses)
+            return ans
+
+        try:
+            for cwd in (repo, os.path.join(repo, 'd0')):
+                lines = prompt(cwd)
+                self.assertEqual(len(lines), 2)
+                self.assertIn(b'master', lines[1])
+            # Once the VCS data is current, only the full prompt is sent. The
+            # end of the walk of the repository counts as a change, so this
+            # can take another query.
+            for i in range(10):
+                lines = prompt(repo)
+                if len(lines) == 1:
+                    break
+            self.assertEqual(len(lines), 1)
+            self.assertIn(b'master', lines[0])
+            # Outside a repository, there is only one line once the root
+            # lookup is cached. Changes to the ancestors of the directory can
+            # invalidate the lookup, so use new directories till one works.
+            for i in range(5):
+                cwd = os.path.join(plain, str(i))
+                os.mkdir(cwd)
+                self.assertTrue(c({'q': 'vcs', 'path': cwd})['ok'])
+                request_id = c.send({'q': 'prompt', 'which': 'right', 'async': '1', 'cwd': cwd})
+                c.recv(request_id, ds=bytes)
+                self.assertTrue(c({'q': 'stats'})['ok'])
+                if request_id not in c.responses:
+                    break
+                c.recv(request_id, ds=bytes)
+            else:
+                self.fail('The async prompt outside a repository was sent twice')
+        finally:
+            c.close()
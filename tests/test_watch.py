@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from watcher import inotify, vcs, workers
+from watcher.vcs import VCSWatcher, git_ignore_modified
+
+
+def git(repo, *args):
+    subprocess.check_call(('git',) + args, cwd=repo, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class WatchTest(unittest.TestCase):
+
+    ' Tests that watch trees, with the walks done in the calling thread '
+
+    def setUp(self):
+        self.base = os.path.realpath(tempfile.mkdtemp())
+        inotify.notifier = inotify.INotify()
+
+    def tearDown(self):
+        vcs.clear_repo_roots()
+        inotify.notifier.close()
+        inotify.notifier = None
+        # gitstatusd can be creating temporary directories in the repository
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def create_repo(self, num_dirs):
+        repo = os.path.join(self.base, 'repo')
+        for i in range(num_dirs):
+            os.makedirs(os.path.join(repo, 'd{}'.format(i)))
+        with open(os.path.join(repo, 'f'), 'w') as f:
+            f.write('f\n')
+        git(repo, 'init', '-q')
+        git(repo, 'add', '-A')
+        git(repo, '-c', 'user.name=test', '-c', 'user.email=test@localhost', 'commit', '-q', '-m', 'initial')
+        return repo
+
+    def watched_dirs(self):
+        ' The directories watched by TreeWatches '
+        return sorted(w['path'] for w in inotify.notifier.watches.values() if any(
+            isinstance(getattr(cb, '__self__', None), inotify.TreeWatch) for cb in w['callbacks'].values()))
+
+
+class TestVCSWatcher(WatchTest):
+
+    def watcher(self, repo, max_dirs):
+        class Watcher(VCSWatcher):
+            pass
+        Watcher.max_dirs = max_dirs
+        return Watcher(repo, 'git', git_ignore_modified)
+
+    def test_max_dirs(self):
+        self.assertEqual(VCSWatcher.max_dirs, inotify.MAX_TREE_DIRS)
+        repo = self.create_repo(20)
+        w = self.watcher(repo, 1000)
+        self.assertTrue(w.is_watched)
+        w.update()
+        self.assertTrue(w.is_current)
+        self.assertIn(os.path.join(repo, 'd1'), self.watched_dirs())
+        w.stop_watching()
+        self.assertFalse(self.watched_dirs())
+
+        # Trees that are too large are not watched, so their data is never current
+        w = self.watcher(repo, 10)
+        self.assertFalse(w.is_watched)
+        self.assertFalse(self.watched_dirs())
+        w.update()
+        self.assertEqual(w.branch_name, 'master')
+        self.assertFalse(w.is_current)
+
+    def test_update_during_walk(self):
+        ' Data is fetched without waiting for the walk, but is only current if fetched after it '
+        repo = self.create_repo(5)
+        walk_allowed = threading.Event()
+
+        class Watcher(VCSWatcher):
+            def walk(self, tree_watch):
+                walk_allowed.wait(10)
+                VCSWatcher.walk(self, tree_watch)
+
+        workers.pool = workers.WorkerPool(1)
+        try:
+            w = Watcher(repo, 'git', git_ignore_modified)
+            w.update()
+            self.assertEqual(w.branch_name, 'master')
+            self.assertFalse(w.is_current)
+            walk_allowed.set()
+            deadline = time.monotonic() + 10
+            while not w.watching.done() and time.monotonic() < deadline:
+                time.sleep(0.01)
+                workers.pool.process_results()
+            self.assertTrue(w.is_watched)
+            self.assertFalse(w.is_current)
+            w.update()
+            self.assertTrue(w.is_current)
+            w.stop_watching()
+        finally:
+            walk_allowed.set()
+            workers.pool.shutdown()
+            workers.pool = None
+
+
+class TestWatchedTree(WatchTest):
+
+    def test_modify(self):
+        ' Writes to files that are kept open are changes to the tree, but not to the repository '
+        from watcher.tree import WatchedTree
+        repo = self.create_repo(2)
+        t = WatchedTree(repo)
+        w = VCSWatcher(repo, 'git', git_ignore_modified)
+        self.assertTrue(t.is_watched)
+        self.assertTrue(w.is_watched)
+        with open(os.path.join(repo, 'd1', 'log'), 'w') as f:
+            inotify.notifier.read_events()
+            token, generation = t.token, w.generation
+            f.write('x')
+            f.flush()
+            inotify.notifier.read_events()
+            self.assertNotEqual(t.token, token)
+            self.assertEqual(w.generation, generation)
+        inotify.notifier.read_events()
+        self.assertNotEqual(w.generation, generation)
+        t.stop_watching()
+        w.stop_watching()
@@ -3,8 +3,11 @@
 # License: GPL v3 Copyright: 2016, Kovid Goyal <kovid at kovidgoyal.net>
 from __future__ import unicode_literals, print_function, division
 
+import math
 import os
-from collections import defaultdict, deque
+import time
+from array import array
+from collections import defaultdict
 
 try:
     from .utils import print_error
@@ -29,9 +32,59 @@ def read(path, is_unit=True):
     return val
 
 
+class MovingAverage:
+
+    ''' The last size values appended, stored in an array used as a ring
+    buffer, with their mean maintained incrementally '''
+
+    def __init__(self, size):
+        self.values = array('d', [0.0]) * size
+        self.size = size
+        self.count = self.pos = 0
+        self.total = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, val):
+        if self.count < self.size:
+            self.count += 1
+        else:
+            self.total -= self.values[self.pos]
+        self.values[self.pos] = val
+        self.total += val
+        self.pos = (self.pos + 1) % self.size
+        if self.pos == 0:
+            # Do not let rounding errors accumulate
+            self.total = math.fsum(self.values)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def latest(self):
+        return self.values[self.pos - 1] if self.count else None
+
+
 def effective_rate(history, current_val):
     history.append(current_val)
-    return sum(history) / len(history)
+    return history.mean
+
+
+def batteries(base):
+    ' The list of batteries, re-read only once a minute '
+    now = time.monotonic()
+    if batteries.ans is None or now - batteries.at > 60:
+        try:
+            batteries.ans = [x for x in os.listdir(base) if x != 'AC']
+        except EnvironmentError:
+            batteries.ans = []
+        batteries.at = now
+    return batteries.ans
+
+
+batteries.ans, batteries.at = None, 0
 
 
 def battery_time():
@@ -44,9 +97,7 @@ def battery_time():
         except EnvironmentError:
             battery_time.has_battery = False
     ans = []
-    for x in os.listdir(base):
-        if x == 'AC':
-            continue
+    for x in batteries(base):
         data = {}
         for k in ('power_now', 'energy_now', 'energy_full'):
             val = data[k] = read(os.path.join(base, x, k))
@@ -65,7 +116,7 @@ def battery_time():
 
 
 battery_time.has_battery = None
-battery_time.history = defaultdict(lambda: {'charging': deque(maxlen=60), 'discharging': deque(maxlen=60)})
+battery_time.history = defaultdict(lambda: {'charging': MovingAverage(60), 'discharging': MovingAverage(60)})
 
 
 if __name__ == '__main__':
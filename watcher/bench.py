@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import argparse
+import errno
+import json
+import os
+import platform
+import selectors
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from .constants import appname, local_socket_address
+from .stats import percentiles
+from .utils import serialize_message, deserialize_message, raise_fd_limit, realpath
+
+
+def start_server(log=os.devnull):
+    ' Run a server in a child process, listening on a private socket '
+    address = ('\0' + appname + '-bench-' + str(os.getpid())).encode('utf-8')
+    pid = os.fork()
+    if pid == 0:
+        try:
+            local_socket_address.ADDRESS = address
+            # gitstatusd and the server log to stderr
+            with open(log, 'ab') as f:
+                os.dup2(f.fileno(), sys.stderr.fileno())
+            from .server import create_server_socket, run_loop
+            run_loop(create_server_socket())
+        except BaseException:
+            pass
+        finally:
+            os._exit(0)
+    for i in range(100):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(address)
+        except OSError:
+            time.sleep(0.05)
+        else:
+            return pid, address
+        finally:
+            s.close()
+    stop_server(pid)
+    raise SystemExit('The benchmark server failed to start')
+
+
+def stop_server(pid):
+    os.kill(pid, signal.SIGINT)
+    os.waitpid(pid, 0)
+
+
+def git(repo, *args):
+    subprocess.check_call(('git',) + args, cwd=repo, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def create_repo(base, num_files, depth, num_untracked):
+    ''' Create a git repository with num_files committed files spread over
+    directories nested depth levels deep and num_untracked untracked files.
+    Returns the repository and a committed file in its deepest directory. '''
+    repo = os.path.join(base, 'repo')
+    dirs = [repo]
+    for i in range(depth):
+        dirs.append(os.path.join(dirs[-1], 'd{}'.format(i)))
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    for i in range(num_files):
+        with open(os.path.join(dirs[i % len(dirs)], 'f{}.txt'.format(i)), 'w') as f:
+            f.write('file {}\n'.format(i))
+    # The file that is modified by the benchmarks
+    path = os.path.join(dirs[-1], 'bench.txt')
+    with open(path, 'w') as f:
+        f.write('bench\n')
+    git(repo, 'init', '-q')
+    git(repo, 'add', '-A')
+    git(repo, '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '-m', 'initial')
+    for i in range(num_untracked):
+        with open(os.path.join(dirs[i % len(dirs)], 'u{}.txt'.format(i)), 'w') as f:
+            f.write('untracked\n')
+    return repo, path
+
+
+def query(address, msg, ds=deserialize_message):
+    ' Make a request the way the shell does, with one connection per request '
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with s:
+        s.connect(address)
+        s.sendall(serialize_message(msg))
+        s.shutdown(socket.SHUT_WR)
+        buf = bytearray()
+        while True:
+            d = s.recv(65536)
+            if not d:
+                break
+            buf += d
+    return ds(bytes(buf))
+
+
+def timed(address, msg):
+    st = time.perf_counter()
+    query(address, msg, ds=bytes)
+    return time.perf_counter() - st
+
+
+def summarize(benchmark, samples, **extra):
+    ans = {'benchmark': benchmark, 'samples': len(samples)}
+    ans.update(extra)
+    ans.update({k + '_ms': v for k, v in percentiles(samples).items()})
+    ans['mean_ms'] = round(1000 * sum(samples) / len(samples), 3)
+    return ans
+
+
+def modify(path):
+    with open(path, 'a') as f:
+        f.write('x')
+
+
+def prompt_latency(address, repo, iterations):
+    ans = []
+    for which in ('left', 'right'):
+        msg = {'q': 'prompt', 'which': which, 'cwd': repo, 'last_exit_code': '0', 'last_pipe_code': '0'}
+        timed(address, msg)
+        ans.append(summarize('prompt_latency', [timed(address, msg) for i in range(iterations)], which=which))
+    return ans
+
+
+def vcs_latency(address, repo, path, iterations):
+    ''' Latency of vcs queries for the first query on a repository, for
+    queries after a change to the working tree and when nothing changed '''
+    msg = {'q': 'vcs', 'path': repo, 'compact': True}
+    ans = [summarize('vcs_latency', [timed(address, msg)], state='first')]
+    changed = []
+    for i in range(iterations):
+        modify(path)
+        changed.append(timed(address, msg))
+    ans.append(summarize('vcs_latency', changed, state='changed'))
+    ans.append(summarize('vcs_latency', [timed(address, msg) for i in range(iterations)], state='unchanged'))
+    return ans
+
+
+def file_status_latency(address, repo, path, iterations):
+    msg = {'q': 'vcs', 'path': os.path.dirname(path), 'subpath': path, 'both': True, 'compact': True}
+    changed = []
+    for i in range(iterations):
+        modify(path)
+        changed.append(timed(address, msg))
+    return [
+        summarize('file_status_latency', changed, state='changed'),
+        summarize('file_status_latency', [timed(address, msg) for i in range(iterations)], state='unchanged'),
+    ]
+
+
+def memory_growth(address, base, num_requests):
+    ''' Make num_requests requests for many different directories, reporting
+    the RSS of the server before and after. The caches in the server are all
+    bounded, so growth should level off. '''
+    dirs = []
+    for i in range(1000):
+        d = os.path.join(base, 'mem', str(i % 10), str(i))
+        os.makedirs(d, exist_ok=True)
+        dirs.append(d)
+    before = query(address, {'q': 'stats'})['rss']
+    st = time.monotonic()
+    for i in range(num_requests):
+        query(address, {'q': 'prompt', 'which': 'right' if i % 2 else 'left', 'cwd': dirs[i % len(dirs)],
+                        'last_exit_code': str(i % 3), 'last_pipe_code': '0'}, ds=bytes)
+    after = query(address, {'q': 'stats'})
+    return {'benchmark': 'memory_growth', 'requests': num_requests, 'seconds': round(time.monotonic() - st, 3),
+            'rss_before': before, 'rss_after': after['rss'], 'rss_growth': after['rss'] - before, 'max_rss': after['max_rss']}
+
+
+def board_latency(address, path, iterations):
+    ''' Latency of reading the VCS data for the directory containing path
+    from the status board, compared to querying the server for it '''
+    from .board import board_path
+    from .client import StatusBoardReader
+    board_file = board_path(address)
+    if board_file is None:
+        return [{'benchmark': 'board_latency', 'skipped': 'XDG_RUNTIME_DIR is not set'}]
+    subdir = os.path.dirname(path)
+    msg = {'q': 'vcs', 'path': subdir, 'compact': True}
+    timed(address, msg)  # publishes the repository on the board
+    reader = StatusBoardReader(board_file)
+    samples, hits = [], 0
+    for i in range(iterations):
+        st = time.perf_counter()
+        ans = reader.vcs(subdir)
+        samples.append(time.perf_counter() - st)
+        hits += ans is not None
+    return [summarize('board_latency', samples, source='board', hits=hits),
+            summarize('board_latency', [timed(address, msg) for i in range(min(iterations, 1000))], source='socket')]
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(
+            ('git', 'rev-parse', 'HEAD'), cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        commit = None
+    return {'benchmark': 'environment', 'commit': commit, 'python': platform.python_version(),
+            'machine': platform.machine(), 'cpus': os.cpu_count(), 'time': int(time.time())}
+
+
+def throughput(address, num_clients, duration, msg):
+    ''' Keep num_clients connections in flight for duration seconds, each
+    making a request and reconnecting as soon as its reply has been read. '''
+    payload = serialize_message(msg)
+    sel = selectors.DefaultSelector()
+    completed = failed = 0
+
+    def start():
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        while True:
+            try:
+                s.connect(address)
+                break
+            except OSError as err:
+                if err.errno != errno.EAGAIN:
+                    raise
+                time.sleep(0.001)  # listen backlog is full
+        s.sendall(payload)
+        s.shutdown(socket.SHUT_WR)
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
+
+    for i in range(num_clients):
+        start()
+    st = time.monotonic()
+    end = st + duration
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        for key, events in sel.select(end - now):
+            s = key.fileobj
+            try:
+                d = s.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                d, failed = b'', failed + 1
+            else:
+                if d:
+                    continue
+                completed += 1
+            sel.unregister(s)
+            s.close()
+            start()
+    elapsed = time.monotonic() - st
+    for key in tuple(sel.get_map().values()):
+        key.fileobj.close()
+    sel.close()
+    return {'benchmark': 'throughput', 'clients': num_clients, 'requests': completed, 'failed': failed,
+            'seconds': round(elapsed, 3), 'requests_per_second': round(completed / elapsed, 1)}
+
+
+def prompt_render(iterations):
+    ' Time rendering of the prompts in-process, without any VCS or socket overhead '
+    from .prompt import prompt_data
+    vcs = {'branch': 'master', 'repo_status': 'M'}
+    ans = []
+    for which, kw in (
+        ('left', {'cwd': '/home/user/some/deep/project/dir', 'user': 'bench', 'home': '/home/user', 'is_ssh': '1'}),
+        ('right', {'cwd': '/tmp', 'last_exit_code': '1', 'vcs': vcs}),
+    ):
+        st = time.perf_counter()
+        for i in range(iterations):
+            prompt_data(which, **kw)
+        elapsed = time.perf_counter() - st
+        ans.append({'benchmark': 'prompt_render', 'which': which, 'iterations': iterations,
+                    'microseconds_per_call': round(1e6 * elapsed / iterations, 3)})
+    return ans
+
+
+def emit(result):
+    print(json.dumps(result), flush=True)
+
+
+BENCHMARKS = ('prompt', 'prompt_latency', 'vcs', 'file_status', 'board', 'throughput', 'memory')
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog=appname + '-bench', description=(
+        'Benchmark the watcher server. A server is run on a private socket and queried about synthetic git repositories.'
+        ' Results are printed as one JSON object per line. Available benchmarks: ' + ', '.join(BENCHMARKS)))
+    parser.add_argument('benchmarks', nargs='*', help='The benchmarks to run, by default all of them')
+    parser.add_argument('--iterations', type=int, default=100000, help='Number of iterations for in-process benchmarks')
+    parser.add_argument('--requests', type=int, default=200, help='Number of requests for each latency measurement')
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 1000, 5000],
+                        help='Numbers of concurrent clients to measure throughput with')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds to run each throughput measurement for')
+    parser.add_argument('--memory-requests', type=int, default=20000, help='Number of requests to make when measuring memory growth')
+    parser.add_argument('--files', type=int, default=1000, help='Number of files in the synthetic repository')
+    parser.add_argument('--depth', type=int, default=5, help='Depth of the directory tree in the synthetic repository')
+    parser.add_argument('--untracked', type=int, default=100, help='Number of untracked files in the synthetic repository')
+    parser.add_argument('--server-log', default=os.devnull, help='File to send the output of the server to')
+    args = parser.parse_args(args)
+    benchmarks = args.benchmarks or BENCHMARKS
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('Unknown benchmarks: ' + ', '.join(sorted(unknown)))
+    emit(environment())
+    if 'prompt' in benchmarks:
+        for x in prompt_render(args.iterations):
+            emit(x)
+    if not set(benchmarks) - {'prompt'}:
+        return
+    raise_fd_limit()
+    base = realpath(tempfile.mkdtemp(prefix=appname + '-bench-'))
+    try:
+        repo, path = create_repo(base, args.files, args.depth, args.untracked)
+        emit({'benchmark': 'repository', 'files': args.files, 'depth': args.depth, 'untracked': args.untracked})
+        pid, address = start_server(args.server_log)
+        try:
+            if 'vcs' in benchmarks:
+                for x in vcs_latency(address, repo, path, args.requests):
+                    emit(x)
+            if 'file_status' in benchmarks:
+                for x in file_status_latency(address, repo, path, args.requests):
+                    emit(x)
+            if 'board' in benchmarks:
+                for x in board_latency(address, path, args.requests):
+                    emit(x)
+            if 'prompt_latency' in benchmarks:
+                for x in prompt_latency(address, repo, args.requests):
+                    emit(x)
+            if 'throughput' in benchmarks:
+                for n in args.clients:
+                    emit(throughput(address, n, args.duration, {'q': 'prompt', 'which': 'left', 'cwd': '/tmp', 'user': 'bench'}))
+            if 'memory' in benchmarks:
+                emit(memory_growth(address, base, args.memory_requests))
+        finally:
+            stop_server(pid)
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import json
+import mmap
+import os
+import struct
+import time
+from zlib import crc32
+
+from .constants import local_socket_address
+from .utils import print_error
+
+# The status board is a memory mapped file that the server publishes the
+# branch and status of watched repositories, the repositories that directories
+# are in and the latest system information to, so that clients can read them
+# without talking to the server at all.
+#
+# Layout, all integers are little endian:
+#
+#     header (HEADER_SIZE bytes): magic, layout version, pid of the server,
+#         number of repository slots, heartbeat (time.time() of the last
+#         housekeeping by the server)
+#     NUM_SLOTS repository slots of SLOT_SIZE bytes each: sequence number,
+#         state, lengths of the root, branch and status followed by the UTF-8
+#         encoded root, branch and status. A length of NONE means None.
+#     NUM_DIR_SLOTS directory slots of DIR_SLOT_SIZE bytes each: sequence
+#         number, state, lengths of the directory and the root of the
+#         repository it is in, followed by them. A root length of NONE means
+#         the directory is not in a repository.
+#     the sysinfo area (SYSINFO_SIZE bytes): sequence number, length of the
+#         JSON encoded system information, followed by it
+#
+# Every slot and the sysinfo area are protected by a seqlock: the writer makes
+# the sequence number odd before changing anything and even again once done.
+# Readers retry if the sequence number is odd or changed while they were
+# reading. The slot for a repository or directory is found by hashing its
+# path, with linear probing over PROBES slots. Directories are only published
+# while the server is watching for changes that would move them to another
+# repository, so readers must not guess the repository from the ancestors of
+# a directory, as nested repositories, submodules and symlinks would make
+# such guesses wrong.
+MAGIC = b'WATCHBRD'
+VERSION = 2
+HEADER = struct.Struct('<8sIIId')
+HEADER_SIZE = 64
+NUM_SLOTS = 512
+SLOT_SIZE = 512
+U32 = struct.Struct('<I')
+# The slot fields after the sequence number
+SLOT = struct.Struct('<IHHH')
+DIR_SLOT = struct.Struct('<IHH')
+SLOT_DATA = 16
+MAX_ROOT, MAX_BRANCH, MAX_STATUS = 320, 160, 16
+NUM_DIR_SLOTS = 1024
+DIR_SLOT_SIZE = SLOT_DATA + 2 * MAX_ROOT
+NONE = 0xffff
+PROBES = 4
+DIRS_OFFSET = HEADER_SIZE + NUM_SLOTS * SLOT_SIZE
+SYSINFO_OFFSET = DIRS_OFFSET + NUM_DIR_SLOTS * DIR_SLOT_SIZE
+SYSINFO_SIZE = 4096
+BOARD_SIZE = SYSINFO_OFFSET + SYSINFO_SIZE
+# Slot states
+EMPTY, CURRENT, STALE = 0, 1, 2
+# The board is ignored by readers if the server has not updated the
+# heartbeat for this long, as it has probably died
+HEARTBEAT_TIMEOUT = 180
+
+# Set by the server to a StatusBoard instance
+writer = None
+
+
+def board_path(address=None):
+    ''' The path to the board file of the server listening at address, or None
+    if there is no per-user runtime directory to put it in '''
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if not base:
+        return None
+    return os.path.join(base, (address or local_socket_address())[1:].decode('utf-8') + '.board')
+
+
+def slot_offset(index):
+    return HEADER_SIZE + index * SLOT_SIZE
+
+
+def dir_slot_offset(index):
+    return DIRS_OFFSET + index * DIR_SLOT_SIZE
+
+
+def probe_slots(key, num_slots=NUM_SLOTS):
+    ' The indices of the slots a repository or directory can be in, key must be bytes '
+    start = crc32(key) % num_slots
+    return ((start + i) % num_slots for i in range(PROBES))
+
+
+def encode(x, limit):
+    if x is None:
+        return b''
+    x = x.encode('utf-8')
+    if len(x) > limit:
+        raise ValueError('Too long')
+    return x
+
+
+class SlotTable:
+
+    ' The slots for repositories or directories, with the paths in them '
+
+    def __init__(self, num_slots, offset, fields):
+        self.num_slots, self.offset, self.fields = num_slots, offset, fields
+        # Map of path to slot index and the paths in the slots
+        self.slots, self.paths = {}, [None] * num_slots
+        self.written_at = [0] * num_slots
+        self.states = [EMPTY] * num_slots
+
+    def allocate(self, path, bpath):
+        index = self.slots.get(path)
+        if index is not None:
+            return index
+        candidates = tuple(probe_slots(bpath, self.num_slots))
+        for index in candidates:
+            if self.paths[index] is None:
+                break
+        else:
+            # Replace the path that was updated the longest time ago
+            index = min(candidates, key=self.written_at.__getitem__)
+            del self.slots[self.paths[index]]
+        self.slots[path] = index
+        self.paths[index] = path
+        return index
+
+
+class StatusBoard:
+
+    ''' The writing side of the board, used by the server. The file is
+    removed when the server exits, after invalidating the header, so that
+    readers that have it mapped know to re-open it. '''
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            os.ftruncate(fd, BOARD_SIZE)
+            self.mmap = mmap.mmap(fd, BOARD_SIZE)
+        finally:
+            os.close(fd)
+        self.mmap[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        self.mmap[HEADER_SIZE:] = bytes(BOARD_SIZE - HEADER_SIZE)
+        self.repos = SlotTable(NUM_SLOTS, slot_offset, SLOT)
+        self.dirs = SlotTable(NUM_DIR_SLOTS, dir_slot_offset, DIR_SLOT)
+        HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, os.getpid(), NUM_SLOTS, time.time())
+
+    def heartbeat(self):
+        HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, os.getpid(), NUM_SLOTS, time.time())
+
+    def begin_write(self, offset):
+        seq = U32.unpack_from(self.mmap, offset)[0]
+        U32.pack_into(self.mmap, offset, (seq + 1) & 0xffffffff)
+        return seq
+
+    def end_write(self, offset, seq):
+        U32.pack_into(self.mmap, offset, (seq + 2) & 0xffffffff)
+
+    def write_slot(self, table, index, state, payload, lengths):
+        offset = table.offset(index)
+        seq = self.begin_write(offset)
+        table.fields.pack_into(self.mmap, offset + 4, state, *lengths)
+        self.mmap[offset + SLOT_DATA:offset + SLOT_DATA + len(payload)] = payload
+        self.end_write(offset, seq)
+        table.states[index] = state
+        table.written_at[index] = time.monotonic()
+
+    def set_state(self, table, index, state):
+        offset = table.offset(index)
+        seq = self.begin_write(offset)
+        U32.pack_into(self.mmap, offset + 4, state)
+        self.end_write(offset, seq)
+        table.states[index] = state
+
+    def remove(self, table, path):
+        index = table.slots.pop(path, None)
+        if index is not None:
+            table.paths[index] = None
+            self.set_state(table, index, EMPTY)
+
+    def repo_updated(self, root, branch, repo_status, current):
+        try:
+            broot, bbranch, bstatus = encode(root, MAX_ROOT), encode(branch, MAX_BRANCH), encode(repo_status, MAX_STATUS)
+        except ValueError:
+            return self.repo_removed(root)  # readers will use the server
+        index = self.repos.allocate(root, broot)
+        lengths = (len(broot), NONE if branch is None else len(bbranch), NONE if repo_status is None else len(bstatus))
+        self.write_slot(self.repos, index, CURRENT if current else STALE, broot + bbranch + bstatus, lengths)
+
+    def repo_changed(self, root):
+        index = self.repos.slots.get(root)
+        if index is not None and self.repos.states[index] == CURRENT:
+            self.set_state(self.repos, index, STALE)
+
+    def repo_removed(self, root):
+        self.remove(self.repos, root)
+
+    def dir_resolved(self, directory, root):
+        try:
+            bdir, broot = encode(directory, MAX_ROOT), encode(root, MAX_ROOT)
+        except ValueError:
+            return self.dir_removed(directory)
+        index = self.dirs.allocate(directory, bdir)
+        self.write_slot(self.dirs, index, CURRENT, bdir + broot, (len(bdir), NONE if root is None else len(broot)))
+
+    def dir_removed(self, directory):
+        self.remove(self.dirs, directory)
+
+    def sysinfo_updated(self, data):
+        payload = json.dumps(data).encode('utf-8')
+        if len(payload) > SYSINFO_SIZE - 8:
+            payload = b''
+        seq = self.begin_write(SYSINFO_OFFSET)
+        U32.pack_into(self.mmap, SYSINFO_OFFSET + 4, len(payload))
+        start = SYSINFO_OFFSET + 8
+        self.mmap[start:start + len(payload)] = payload
+        self.end_write(SYSINFO_OFFSET, seq)
+
+    def close(self):
+        # Invalidate the board for readers that have it mapped
+        self.mmap[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        self.mmap.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def open_board():
+    global writer
+    path = board_path()
+    if path is not None:
+        try:
+            writer = StatusBoard(path)
+        except (OSError, ValueError) as err:
+            print_error('Failed to create the status board with error:', err)
+    return writer
+
+
+def close_board():
+    global writer
+    if writer is not None:
+        writer.close()
+        writer = None
+
+
+# The functions below do nothing if there is no board, so that they can be
+# called unconditionally
+
+def repo_updated(root, branch, repo_status, current):
+    ' Publish the state of a repository, current must be False if it may have changed since the state was read '
+    if writer is not None:
+        writer.repo_updated(root, branch, repo_status, current)
+
+
+def repo_changed(root):
+    if writer is not None:
+        writer.repo_changed(root)
+
+
+def repo_removed(root):
+    if writer is not None:
+        writer.repo_removed(root)
+
+
+def dir_resolved(directory, root):
+    ' Publish the root of the repository directory is in, or None if it is not in one '
+    if writer is not None:
+        writer.dir_resolved(directory, root)
+
+
+def dir_removed(directory):
+    if writer is not None:
+        writer.dir_removed(directory)
+
+
+def sysinfo_updated(data):
+    if writer is not None:
+        writer.sysinfo_updated(data)
+
+
+def heartbeat():
+    if writer is not None:
+        writer.heartbeat()
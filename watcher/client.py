@@ -6,10 +6,21 @@ from __future__ import absolute_import, unicode_literals
 import socket
 import errno
 import functools
+import json
+import mmap
 import os
+import sys
+import time
+from collections import deque
 
+from .board import (
+    BOARD_SIZE, CURRENT, DIR_SLOT, EMPTY, HEADER, HEARTBEAT_TIMEOUT, MAGIC, NONE, NUM_DIR_SLOTS, NUM_SLOTS, SLOT, SLOT_DATA,
+    SYSINFO_OFFSET, U32, VERSION, board_path, dir_slot_offset, probe_slots, slot_offset
+)
 from .constants import local_socket_address
-from .utils import serialize_message, deserialize_message, realpath
+from .utils import (
+    serialize_message, deserialize_message, realpath, FRAMED_MAGIC, serialize_frame, parse_frames
+)
 
 is_cli = False
 
@@ -30,13 +41,14 @@ def eintr_retry_call(func, *args):
 
 
 def recv_msg(s, ds=deserialize_message):
-    buf = b''
-    while True:
-        d = eintr_retry_call(s.recv, 4096)
-        if d:
-            buf += d
-        else:
-            break
+    buf, chunk = bytearray(), bytearray(64 * 1024)
+    with memoryview(chunk) as m:
+        while True:
+            n = eintr_retry_call(s.recv_into, chunk)
+            if n:
+                buf += m[:n]
+            else:
+                break
     try:
         return ds(buf)
     finally:
@@ -65,32 +77,320 @@ def connect():
     return s
 
 
-@entry
-def vcs(s, args):
-    path = realpath(args.path)
-    both = args.both
+class Connection:
+
+    ''' A persistent connection to the daemon using the framed protocol.
+    Several requests can be sent before reading any of the responses, use
+    send() and recv() for that or just call the connection with a message
+    to get the response. Use subscribe() to be told about changes to topics.
+    If the daemon goes away the connection is re-opened
+    on the next request. '''
+
+    def __init__(self):
+        self.socket = None
+        self.request_id = 0
+        self.rbuf = bytearray()
+        self.read_buffer = bytearray(64 * 1024)
+        self.responses = {}
+
+    def ensure_connected(self):
+        if self.socket is None:
+            s = connect()
+            if s is None:
+                raise EnvironmentError('No running daemon found at: {!r}'.format(local_socket_address()))
+            self.socket = s
+            self.rbuf = bytearray()
+            self.responses.clear()
+            s.sendall(FRAMED_MAGIC)
+        return self.socket
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def send(self, msg):
+        s = self.ensure_connected()
+        self.request_id = (self.request_id + 1) & 0xffffffff
+        try:
+            s.sendall(serialize_frame(self.request_id, msg))
+        except EnvironmentError:
+            self.close()
+            raise
+        return self.request_id
+
+    def recv(self, request_id, ds=deserialize_message):
+        while request_id not in self.responses:
+            if self.socket is None:
+                raise EnvironmentError('Connection to the daemon was closed')
+            try:
+                n = eintr_retry_call(self.socket.recv_into, self.read_buffer)
+            except EnvironmentError:
+                self.close()
+                raise
+            if not n:
+                self.close()
+                raise EnvironmentError('Connection to the daemon was closed')
+            with memoryview(self.read_buffer) as m:
+                self.rbuf += m[:n]
+            for rid, payload in parse_frames(self.rbuf):
+                # There can be several responses with the same id, for
+                # subscriptions and async prompts
+                self.responses.setdefault(rid, deque()).append(payload)
+        q = self.responses[request_id]
+        ans = q.popleft()
+        if not q:
+            del self.responses[request_id]
+        return ds(ans)
+
+    def __call__(self, msg, ds=deserialize_message):
+        was_connected = self.socket is not None
+        try:
+            return self.recv(self.send(msg), ds)
+        except EnvironmentError:
+            if not was_connected:
+                raise
+            # Stale connection from a previous daemon, retry once
+            return self.recv(self.send(msg), ds)
+
+    def subscribe(self, topics):
+        ''' Subscribe to the specified topics, yielding (topic, data) every time
+        one of them changes, starting with their current values. Topics are:
+        clock, sysinfo and vcs:/path/to/dir '''
+        request_id = self.send({'q': 'subscribe', 'topics': list(topics)})
+        ans = self.recv(request_id)
+        if not ans.get('ok'):
+            raise ValueError(ans['msg'])
+        while True:
+            msg = self.recv(request_id)
+            yield msg['topic'], msg['data']
+
+
+class StatusBoardReader:
+
+    ''' Read the status board published by the daemon, see board.py for the
+    layout. Reads do not need any system calls, except when the board has to
+    be (re-)opened. The methods return None when the board does not have an
+    up to date answer, use the daemon in that case. '''
+
+    # Number of times to retry a read that raced with the daemon writing
+    RETRIES = 100
+
+    def __init__(self, path=None):
+        self.path = path
+        self.mmap = None
+
+    def open(self):
+        path = self.path or board_path()
+        if path is None:
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            return
+        try:
+            self.mmap = mmap.mmap(fd, BOARD_SIZE, prot=mmap.PROT_READ)
+        except (OSError, ValueError):
+            pass
+        finally:
+            os.close(fd)
+        return self.mmap
+
+    def board(self):
+        m = self.mmap or self.open()
+        if m is not None:
+            magic, version, pid, num_slots, heartbeat = HEADER.unpack_from(m, 0)
+            if magic == MAGIC and version == VERSION and time.time() - heartbeat < HEARTBEAT_TIMEOUT:
+                return m
+            # The daemon has exited or died, re-open the board next time
+            m.close()
+            self.mmap = None
+
+    def read_slot(self, m, offset, fields, key):
+        ''' Return None if the slot at offset is not for key, False if it is
+        but its data is not current, otherwise its other fields, as bytes or
+        None '''
+        for i in range(self.RETRIES):
+            seq = U32.unpack_from(m, offset)[0]
+            if seq & 1:
+                continue
+            values = fields.unpack_from(m, offset + 4)
+            state, kl, lengths = values[0], values[1], values[2:]
+            ans = None
+            if state != EMPTY and kl == len(key) and m[offset + SLOT_DATA:offset + SLOT_DATA + kl] == key:
+                ans = False
+                if state == CURRENT:
+                    pos, ans = offset + SLOT_DATA + kl, []
+                    for length in lengths:
+                        if length == NONE:
+                            ans.append(None)
+                        else:
+                            ans.append(m[pos:pos + length])
+                            pos += length
+            if U32.unpack_from(m, offset)[0] == seq:
+                return ans
+        return False
+
+    def lookup(self, m, key, num_slots, offset, fields):
+        for index in probe_slots(key, num_slots):
+            ans = self.read_slot(m, offset(index), fields, key)
+            if ans is not None:
+                return ans or None
+
+    def vcs(self, path):
+        ''' Return the branch and status of the repository containing the
+        directory path. path must be absolute and without symlinks, as the
+        daemon uses resolved paths. Only directories the daemon has
+        resolved are on the board, the repository is never guessed from the
+        ancestors of path. '''
+        m = self.board()
+        if m is None:
+            return
+        directory = (path.rstrip('/') or '/').encode('utf-8')
+        ans = self.lookup(m, directory, NUM_DIR_SLOTS, dir_slot_offset, DIR_SLOT)
+        if ans is None:
+            return
+        root = ans[0]
+        if root is None:
+            return {'branch': None, 'repo_status': None}  # not in a repository
+        ans = self.lookup(m, root, NUM_SLOTS, slot_offset, SLOT)
+        if ans is not None:
+            return {'branch': None if ans[0] is None else ans[0].decode('utf-8'),
+                    'repo_status': None if ans[1] is None else ans[1].decode('utf-8')}
+
+    def sysinfo(self):
+        m = self.board()
+        if m is None:
+            return
+        for i in range(self.RETRIES):
+            seq = U32.unpack_from(m, SYSINFO_OFFSET)[0]
+            if seq & 1:
+                continue
+            size = U32.unpack_from(m, SYSINFO_OFFSET + 4)[0]
+            raw = m[SYSINFO_OFFSET + 8:SYSINFO_OFFSET + 8 + size]
+            if U32.unpack_from(m, SYSINFO_OFFSET)[0] == seq:
+                break
+        else:
+            return
+        if raw:
+            ans = json.loads(raw)
+            # The daemon stops sampling when nobody asks it for system information
+            if time.time() - ans['sampled_at'] < 3 * ans['interval']:
+                return ans
+
+
+board_reader = StatusBoardReader()
+
+
+def query_daemon(msg, connection=None):
+    c = connection or Connection()
+    try:
+        ans = c(msg)
+    finally:
+        if connection is None:
+            c.close()
+    if not ans.get('ok'):
+        raise ValueError(ans['msg'])
+    return ans
+
+
+def repo_state(path, connection=None):
+    ''' The branch and status of the repository containing the directory
+    path, read from the status board, or queried from the daemon if the board
+    does not have it. '''
+    ans = board_reader.vcs(os.path.abspath(path))
+    if ans is None:
+        ans = query_daemon({'q': 'vcs', 'path': realpath(path)}, connection)
+        ans = {'branch': ans.get('branch'), 'repo_status': ans.get('repo_status')}
+    return ans
+
+
+def system_info(connection=None):
+    ''' The latest system information sampled by the daemon, read from the
+    status board, or queried from the daemon if the board does not have it. '''
+    ans = board_reader.sysinfo()
+    if ans is None:
+        ans = query_daemon({'q': 'sysinfo'}, connection)
+        ans.pop('ok')
+    return ans
+
+
+def vcs_query(path, both=False):
+    path = realpath(path)
     subpath = None
     if os.path.isdir(path):
         both = False
     else:
         subpath, path = path, os.path.dirname(path)
-    send_msg(s, {'q': 'vcs', 'path': path, 'subpath': subpath, 'both': both})
+    return path, subpath, both
+
+
+@entry
+def vcs(s, args):
+    if len(args.path) > 1:
+        queries = [vcs_query(p)[:2] for p in args.path]
+        send_msg(s, {'q': 'vcs_batch', 'queries': queries, 'compact': True})
+        ans = recv_msg(s)
+        for path, result in zip(args.path, ans.get('results', ())):
+            print(path, result)
+        if not ans.get('ok'):
+            print(ans)
+        return
+    path, subpath, both = vcs_query(args.path[0], args.both)
+    send_msg(s, {'q': 'vcs', 'path': path, 'subpath': subpath, 'both': both, 'compact': True})
     print(recv_msg(s))
 
 
 @entry
 def watch(s, args):
-    send_msg(s, {'q': 'watch', 'path': realpath(args.path)})
+    send_msg(s, {'q': 'watch', 'path': realpath(args.path), 'token': args.token})
     print(recv_msg(s))
 
 
 @entry
 def prompt(s, args):
-    send_msg(s, {'q': 'prompt', 'which': args.which, 'cwd': realpath(args.cwd), 'last_exit_code': args.last_exit_code,
-                 'last_pipe_code': args.last_pipe_code})
+    msg = {'q': 'prompt', 'which': args.which, 'cwd': realpath(args.cwd or os.getcwd()), 'last_exit_code': args.last_exit_code,
+           'last_pipe_code': args.last_pipe_code}
+    if args.stale:
+        msg['stale'] = '1'
+    send_msg(s, msg)
     print(recv_msg(s, ds=lambda x: x.decode('utf-8')))
 
 
+@entry
+def stats(s, args):
+    send_msg(s, {'q': 'stats'})
+    print(json.dumps(recv_msg(s), indent=2, sort_keys=True))
+
+
+def sysinfo(args):
+    try:
+        ans = system_info()
+    except (EnvironmentError, ValueError) as err:
+        raise SystemExit(str(err))
+    print(json.dumps(ans, indent=2, sort_keys=True))
+
+
+def subscribe(args):
+    c = Connection()
+    try:
+        for topic, data in c.subscribe(args.topics):
+            print(json.dumps({'topic': topic, 'data': data}, sort_keys=True))
+            sys.stdout.flush()
+    except (EnvironmentError, ValueError) as err:
+        raise SystemExit(str(err))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        c.close()
+
+
+@entry
+def chpwd(s, args):
+    send_msg(s, {'q': 'chpwd', 'cwd': realpath(args.path or os.getcwd())})
+    s.close()
+
+
 def main(args):
     global is_cli
     is_cli = True
@@ -100,4 +400,15 @@ def main(args):
         return vcs(args)
     elif args.q == 'watch':
         return watch(args)
+    elif args.q == 'chpwd':
+        return chpwd(args)
+    elif args.q == 'stats':
+        return stats(args)
+    elif args.q == 'sysinfo':
+        return sysinfo(args)
+    elif args.q == 'subscribe':
+        return subscribe(args)
+    elif args.q == 'shell':
+        from .shell import main
+        return main(args)
     raise SystemExit('Unknown query: {}'.format(args.q))
@@ -4,75 +4,173 @@
 
 import atexit
 import os
+import select
 import subprocess
 import threading
+from concurrent.futures import Future
 
 # gitstatud the exe comes from https://github.com/romkatv/gitstatus
 exe = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gitstatusd')
 
 
+def parse_response(fields, path):
+    if fields[1] == '0':
+        raise NotADirectoryError(f'{path} is not a git repository')
+    return {
+        'workdir': fields[2],
+        'HEAD': fields[3],
+        'branch_name': fields[4],
+        'upstream_branch_name': fields[5],
+        'remote_branch_name': fields[6],
+        'remote_url': fields[7],
+        'repo_state': fields[8],
+        'num_files_in_index': int(fields[9] or 0),
+        'num_staged_changes': int(fields[10] or 0),
+        'num_unstaged_changes': int(fields[11] or 0),
+        'num_conflicted_changes': int(fields[12] or 0),
+        'num_untracked_files': int(fields[13] or 0),
+        'num_commits_ahead_of_upstream': int(fields[14] or 0),
+        'num_commits_behind_upstream': int(fields[15] or 0),
+        'num_stashes': int(fields[16] or 0),
+        'last_tag_pointing_to_HEAD': fields[17],
+        'num_unstaged_deleted_files': int(fields[18] or 0),
+        'num_staged_new_files': int(fields[19] or 0),
+        'num_staged_deleted_files': int(fields[20] or 0),
+        'push_remote_name': fields[21],
+        'push_remote_url': fields[22],
+        'num_commits_ahead_of_push': int(fields[23] or 0),
+        'num_commits_behind_of_push': int(fields[24] or 0),
+        'num_files_with_skip_worktree_set': int(fields[25] or 0),
+        'num_files_with_assume_unchanged_set': int(fields[26] or 0),
+        'encoding_of_head': fields[27] or 'utf-8',
+        'head_first_para': fields[28],
+    }
+
+
 class GSD:
 
+    ''' Client for gitstatusd. Requests are tagged with ids, so any number of
+    them can be in flight at once, gitstatusd processes them in parallel.
+    submit() returns a Future that is completed when the response for it is
+    read. An event loop can watch fileno() and call read_responses() when it
+    is readable, calling the object instead blocks until the response for that
+    request arrives, reading responses for other requests on the way. '''
+
     def __init__(self):
+        self.process = None
+        self.started_callback = self.stopped_callback = None
+        self.request_id = 0
+        self.pending = {}
+        self.rbuf = b''
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        atexit.register(self.terminate)
+        self.start()
+
+    def start(self):
+        ''' Start gitstatusd, replacing the previous process, if any. Returns
+        the futures of the requests sent to the previous process, which will
+        never get a response. They must be failed by the caller, after
+        releasing write_lock, as their callbacks can submit new requests. '''
+        orphans = ()
+        if self.process is not None:
+            orphans, self.pending = tuple(self.pending.values()), {}
+            if self.stopped_callback is not None:
+                # Must be called while the old fd is still open, as the new
+                # pipe can re-use its number
+                self.stopped_callback(self)
+            self.process.stdin.close()
+            self.process.stdout.close()
+            self.process.wait()
         self.process = subprocess.Popen(
             [exe, '--num-threads=' + str(2 * len(os.sched_getaffinity(0)))],
             stdin=subprocess.PIPE, stdout=subprocess.PIPE
         )
-        atexit.register(self.terminate)
-        self.request_id = 0
-        self.lock = threading.Lock()
+        os.set_blocking(self.process.stdout.fileno(), False)
+        self.rbuf = b''
+        if self.started_callback is not None:
+            self.started_callback(self)
+        return orphans
 
     def terminate(self):
-        if self.process.returncode is None:
+        if self.process is not None and self.process.returncode is None:
             self.process.terminate()
-            if self.process.wait(0.1) is None:
+            try:
+                self.process.wait(0.1)
+            except subprocess.TimeoutExpired:
                 self.process.kill()
                 self.process.wait()
     __del__ = terminate
 
-    def __call__(self, path):
-        with self.lock:
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def submit(self, path):
+        fut = Future()
+        orphans = ()
+        with self.write_lock:
+            if self.process.poll() is not None:
+                orphans = self.start()
             self.request_id += 1
+            self.pending[str(self.request_id)] = path, fut
             rq = f'{self.request_id}\x1f{path}\x1e'
-            self.process.stdin.write(rq.encode('utf-8'))
-            self.process.stdin.flush()
-            resp = b''
-            while b'\x1e' not in resp:
-                resp += os.read(self.process.stdout.fileno(), 8192)
-            fields = resp.rstrip(b'\x1e').decode('utf-8', 'replace').split('\x1f')
-            if fields[0] != str(self.request_id):
-                raise ValueError(f'Got invalid response id: {fields[0]}')
-            if fields[1] == '0':
-                raise NotADirectoryError(f'{path} is not a git repository')
-            return {
-                'workdir': fields[2],
-                'HEAD': fields[3],
-                'branch_name': fields[4],
-                'upstream_branch_name': fields[5],
-                'remote_branch_name': fields[6],
-                'remote_url': fields[7],
-                'repo_state': fields[8],
-                'num_files_in_index': int(fields[9] or 0),
-                'num_staged_changes': int(fields[10] or 0),
-                'num_unstaged_changes': int(fields[11] or 0),
-                'num_conflicted_changes': int(fields[12] or 0),
-                'num_untracked_files': int(fields[13] or 0),
-                'num_commits_ahead_of_upstream': int(fields[14] or 0),
-                'num_commits_behind_upstream': int(fields[15] or 0),
-                'num_stashes': int(fields[16] or 0),
-                'last_tag_pointing_to_HEAD': fields[17],
-                'num_unstaged_deleted_files': int(fields[18] or 0),
-                'num_staged_new_files': int(fields[19] or 0),
-                'num_staged_deleted_files': int(fields[20] or 0),
-                'push_remote_name': fields[21],
-                'push_remote_url': fields[22],
-                'num_commits_ahead_of_push': int(fields[23] or 0),
-                'num_commits_behind_of_push': int(fields[24] or 0),
-                'num_files_with_skip_worktree_set': int(fields[25] or 0),
-                'num_files_with_assume_unchanged_set': int(fields[26] or 0),
-                'encoding_of_head': fields[27] or 'utf-8',
-                'head_first_para': fields[28],
-            }
+            try:
+                self.process.stdin.write(rq.encode('utf-8'))
+                self.process.stdin.flush()
+            except OSError as err:
+                self.pending.pop(str(self.request_id), None)
+                fut.set_exception(err)
+        for path, orphan in orphans:
+            orphan.set_exception(EOFError('gitstatusd exited unexpectedly'))
+        return fut
+
+    def read_responses(self, block=False):
+        ' Read and dispatch all available responses, returns False if gitstatusd has exited '
+        fd = self.fileno()
+        if block:
+            select.select([fd], [], [])
+        while True:
+            try:
+                data = os.read(fd, 64 * 1024)
+            except (BlockingIOError, InterruptedError):
+                return True
+            if not data:
+                self.fail_pending(EOFError('gitstatusd exited unexpectedly'))
+                return False
+            self.rbuf += data
+            if b'\x1e' in data:
+                records = self.rbuf.split(b'\x1e')
+                self.rbuf = records.pop()
+                for record in records:
+                    self.dispatch(record)
+
+    def dispatch(self, record):
+        fields = record.decode('utf-8', 'replace').split('\x1f')
+        x = self.pending.pop(fields[0], None)
+        if x is None:
+            return
+        path, fut = x
+        try:
+            ans = parse_response(fields, path)
+        except Exception as err:
+            fut.set_exception(err)
+        else:
+            fut.set_result(ans)
+
+    def fail_pending(self, err):
+        with self.write_lock:
+            pending, self.pending = self.pending, {}
+            self.process.wait()
+        for path, fut in pending.values():
+            fut.set_exception(err)
+
+    def __call__(self, path):
+        fut = self.submit(path)
+        while not fut.done():
+            with self.read_lock:
+                if not fut.done():
+                    self.read_responses(block=True)
+        return fut.result()
 
 
 def test():
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import threading
+import traceback
+from functools import partial
+
+from .utils import print_error
+from .workers import run_blocking
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_MASK_ADD = 0x20000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = os.O_CLOEXEC
+IN_NONBLOCK = os.O_NONBLOCK
+
+# The events that can change the output of git status or the set of
+# directories in a tree. IN_MODIFY is not included, as it is sent for every
+# write, and files that are written to continuously, such as logs, would then
+# cause a flood of git status queries. IN_CLOSE_WRITE reports such changes
+# once the file is closed.
+TREE_EVENTS = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW |
+    IN_EXCL_UNLINK
+)
+
+event_header = struct.Struct('iIII')
+
+# Set by the server to an INotify instance, when it is None, no file system
+# watching is done and every query hits the file system/VCS
+notifier = None
+# Trees with more directories than this are not watched, as every directory
+# uses up one of the watches the user is allowed
+MAX_TREE_DIRS = 8192
+
+
+def load_libc():
+    if load_libc.ans is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        for name, argtypes in (
+                ('inotify_init1', (ctypes.c_int,)),
+                ('inotify_add_watch', (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)),
+                ('inotify_rm_watch', (ctypes.c_int, ctypes.c_int))):
+            f = getattr(libc, name)
+            f.argtypes, f.restype = argtypes, ctypes.c_int
+        load_libc.ans = libc
+    return load_libc.ans
+
+
+load_libc.ans = None
+
+
+def check_call(func, *args):
+    while True:
+        ans = func(*args)
+        if ans != -1:
+            return ans
+        eno = ctypes.get_errno()
+        if eno != errno.EINTR:
+            raise OSError(eno, os.strerror(eno))
+
+
+class INotify:
+
+    ''' A thin wrapper around the Linux inotify API. Several callbacks can be
+    registered for the same directory, they are called as callback(path, name,
+    mask) where path is the watched directory and name is the name of the
+    entry inside it that the event refers to (empty for events on the
+    directory itself). Watches can be added from any thread, callbacks are
+    called in the thread that calls read_events(). '''
+
+    def __init__(self):
+        self.libc = load_libc()
+        self.fd = check_call(self.libc.inotify_init1, IN_CLOEXEC | IN_NONBLOCK)
+        self.watches = {}
+        self.wd_for_path = {}
+        self.callback_counter = 0
+        self.lock = threading.Lock()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        with self.lock:
+            if self.fd > -1:
+                os.close(self.fd)
+                self.fd = -1
+                self.watches.clear()
+                self.wd_for_path.clear()
+
+    def add_watch(self, path, mask, callback):
+        mask |= IN_MASK_ADD
+        # The lock is held across the system call, so that events for a new
+        # watch cannot be dispatched before it is registered
+        with self.lock:
+            wd = check_call(self.libc.inotify_add_watch, self.fd, os.fsencode(path), mask)
+            w = self.watches.get(wd)
+            if w is None:
+                w = self.watches[wd] = {'path': path, 'callbacks': {}}
+                self.wd_for_path[path] = wd
+            elif w['path'] != path:
+                # The directory has been renamed since it was first watched
+                if self.wd_for_path.get(w['path']) == wd:
+                    del self.wd_for_path[w['path']]
+                w['path'] = path
+                self.wd_for_path[path] = wd
+            self.callback_counter += 1
+            w['callbacks'][self.callback_counter] = callback
+            return wd, self.callback_counter
+
+    def rm_watch(self, key):
+        wd, cid = key
+        with self.lock:
+            w = self.watches.get(wd)
+            if w is None:
+                return
+            w['callbacks'].pop(cid, None)
+            if not w['callbacks']:
+                self.forget(wd)
+                try:
+                    check_call(self.libc.inotify_rm_watch, self.fd, wd)
+                except OSError as err:
+                    if err.errno != errno.EINVAL:
+                        raise
+
+    def forget(self, wd):
+        # Must be called with the lock held
+        w = self.watches.pop(wd, None)
+        if w is not None and self.wd_for_path.get(w['path']) == wd:
+            del self.wd_for_path[w['path']]
+
+    def read_events(self):
+        while True:
+            try:
+                raw = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            except InterruptedError:
+                continue
+            if not raw:
+                break
+            self.dispatch(raw)
+
+    def dispatch(self, raw):
+        pos, sz = 0, event_header.size
+        while pos < len(raw):
+            wd, mask, cookie, name_len = event_header.unpack_from(raw, pos)
+            pos += sz
+            name = os.fsdecode(raw[pos:pos + name_len].rstrip(b'\0'))
+            pos += name_len
+            with self.lock:
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, tell everybody that something changed
+                    targets = [(w['path'], tuple(w['callbacks'].values())) for w in self.watches.values()]
+                    name = ''
+                else:
+                    w = self.watches.get(wd)
+                    if w is None:
+                        continue
+                    if mask & IN_IGNORED:
+                        self.forget(wd)
+                        continue
+                    targets = ((w['path'], tuple(w['callbacks'].values())),)
+            for path, callbacks in targets:
+                self.call(path, callbacks, name, mask)
+
+    def call(self, path, callbacks, name, mask):
+        for callback in callbacks:
+            try:
+                callback(path, name, mask)
+            except Exception:
+                print_error(traceback.format_exc())
+
+
+class TreeWatch:
+
+    ''' Watch a set of directory trees, recursively. New sub-directories are
+    watched as they are created. callback(path, name, mask) is called for
+    every event. prune(parent, name) can be used to exclude sub-directories
+    from the recursive watch. If a watch could not be added, for example,
+    because the system limit on watches was reached or the tree has more than
+    max_dirs directories, failed is set to True and events for the tree are no
+    longer reliable. Walking a tree is slow, so add_tree() can be called in a
+    worker thread, sub-directories created later are walked with
+    run_blocking() and the callback is called once more when that is done.
+    events is the mask of events to watch for in every directory. '''
+
+    def __init__(self, notifier, callback, prune=None, max_dirs=None, events=TREE_EVENTS):
+        self.notifier = notifier
+        self.callback = callback
+        self.events = events
+        self.prune = prune
+        self.max_dirs = max_dirs
+        self.keys = {}
+        self.recursive = set()
+        self.failed = self.closed = False
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add_dir(self, path, recursive=False):
+        ' Watch path, returns False if the tree watch has been closed '
+        with self.lock:
+            if self.closed:
+                return False
+            if path not in self.keys:
+                if self.max_dirs is not None and len(self.keys) >= self.max_dirs:
+                    self.failed = True
+                    raise OSError(errno.ENOSPC, 'More than {} directories in the tree'.format(self.max_dirs))
+                self.keys[path] = self.notifier.add_watch(path, self.events, self.on_event)
+            if recursive:
+                self.recursive.add(path)
+        return True
+
+    def add_tree(self, path):
+        if self.add_dir(path, recursive=True):
+            self.add_children(path)
+
+    def add_children(self, path):
+        # Every directory is watched before it is scanned, so that children
+        # created during the scan are not missed
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            try:
+                entries = tuple(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                if is_dir and (self.prune is None or not self.prune(path, entry.name)):
+                    try:
+                        if not self.add_dir(entry.path, recursive=True):
+                            return
+                    except (FileNotFoundError, PermissionError):
+                        continue
+                    stack.append(entry.path)
+
+    def add_new_children(self, path):
+        # Called in a worker thread
+        try:
+            self.add_children(path)
+        except OSError:
+            self.failed = True
+
+    def new_children_added(self, path, mask, fut):
+        if not self.closed:
+            self.callback(path, '', mask)
+
+    def remove_dir(self, path):
+        prefix = path + os.sep
+        with self.lock:
+            for p in tuple(self.keys):
+                if p == path or p.startswith(prefix):
+                    self.notifier.rm_watch(self.keys.pop(p))
+                    self.recursive.discard(p)
+
+    def on_event(self, path, name, mask):
+        if not mask & (self.events | IN_Q_OVERFLOW | IN_UNMOUNT):
+            return  # for another watch of the same directory with a different mask
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost, so directories created in the meantime may
+            # not be watched
+            self.failed = True
+        if mask & IN_ISDIR and name and path in self.recursive:
+            child = os.path.join(path, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if self.prune is None or not self.prune(path, name):
+                    try:
+                        added = self.add_dir(child, recursive=True)
+                    except (FileNotFoundError, PermissionError):
+                        added = False
+                    except OSError:
+                        added, self.failed = False, True
+                    if added:
+                        # A directory moved into the tree can be large
+                        run_blocking(None, self.add_new_children, child).add_done_callback(partial(self.new_children_added, child, mask))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.remove_dir(child)
+        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            with self.lock:
+                self.keys.pop(path, None)
+                self.recursive.discard(path)
+        self.callback(path, name, mask)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for key in self.keys.values():
+                self.notifier.rm_watch(key)
+            self.keys.clear()
+            self.recursive.clear()
+
+
+class TreeWatcher:
+
+    ''' Base class for watching a tree, walking it in a worker thread, as that
+    is slow for large trees. Sub-classes implement walk(tree_watch) to add the
+    watches and tree_changed(path, name, mask). Until the walk is done, and if
+    it fails, for example because the tree has more than max_dirs
+    directories, is_watched is False and the state of the tree must not be
+    cached. '''
+
+    prune = None
+    max_dirs = MAX_TREE_DIRS
+    events = TREE_EVENTS
+
+    def __init__(self, path):
+        self.path = path
+        # A Future that completes once the whole tree is being watched
+        self.watching = self.tree_watch = None
+
+    def start_watching(self):
+        if notifier is not None:
+            self.tree_watch = TreeWatch(notifier, self.tree_changed, prune=self.prune, max_dirs=self.max_dirs, events=self.events)
+            self.watching = run_blocking(None, self.add_watches, self.tree_watch)
+            self.watching.add_done_callback(self.watches_added)
+
+    def add_watches(self, tree_watch):
+        # Called in a worker thread
+        try:
+            self.walk(tree_watch)
+        except OSError as err:
+            return err
+
+    def watches_added(self, fut):
+        err = fut.result()
+        if err is not None and self.tree_watch is not None:
+            print_error('Failed to watch {} for changes, with error: {}'.format(self.path, err))
+            self.stop_watching()
+
+    def stop_watching(self):
+        if self.tree_watch is not None:
+            self.tree_watch.close()
+            self.tree_watch = None
+
+    @property
+    def is_watched(self):
+        return self.tree_watch is not None and not self.tree_watch.failed and self.watching.done()
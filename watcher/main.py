@@ -6,7 +6,6 @@ import argparse
 import os
 
 from .constants import appname
-from .utils import realpath
 
 
 def server(args):
@@ -41,25 +40,52 @@ def parser():
     subparsers = c.add_subparsers(help='Choose query to make of the server')
 
     v = subparsers.add_parser('vcs', help='Query the VCS status of a directory')
-    v.add_argument('path', help='Path of directory or file to query')
+    v.add_argument('path', nargs='+', help='Path of directory or file to query, if more than one path is specified,'
+                   ' they are all queried with a single request')
     v.add_argument('--both', action='store_true', help='If True, both the repo status and the status of the file passed in as path will be queried')
     v.set_defaults(q='vcs')
 
     v = subparsers.add_parser('watch', help='Check if a directory tree has changed since the last call')
     v.add_argument('path', help='Path of directory to query')
+    v.add_argument('--token', help='The token returned by the previous call, the tree is reported as changed'
+                   ' if anything in it was modified after that token was generated')
     v.set_defaults(q='watch')
 
     v = subparsers.add_parser('prompt', help='Get a nice rendered prompt for use with PS1/RPS1')
     v.add_argument('which', choices=('left', 'right'), help='left or right prompt')
-    v.add_argument('--cwd', default=realpath(os.getcwd()), help='The current working directory for this query')
-    v.add_argument('--home', default=realpath(os.path.expanduser('~')), help='The home directory')
-    v.add_argument('--user', default=os.environ.get('USER', os.path.basename(os.path.expanduser('~'))),
-                   help='The current username')
+    v.add_argument('--cwd', help='The current working directory for this query, defaults to the current directory')
+    v.add_argument('--home', help='The home directory, defaults to the home directory of the current user')
+    v.add_argument('--user', help='The current username, defaults to the current user')
     v.add_argument('--last-exit-code', default='0', help='The last exit code to display')
     v.add_argument('--last-pipe-code', default='0', help='The last pipe exit code to display')
     v.add_argument('--is-ssh', default='1' if is_ssh() else '0', help='Set to 1 if this is an SSH session')
+    v.add_argument('--stale', action='store_true', help='Render the right prompt immediately with the last known'
+                   ' VCS data, if any, instead of waiting for it to be refreshed. It is refreshed in the background.')
     v.set_defaults(q='prompt')
 
+    v = subparsers.add_parser('stats', help='Print statistics about the server: query counts and latencies,'
+                              ' cache hit rates, memory usage, etc.')
+    v.set_defaults(q='stats')
+
+    v = subparsers.add_parser('sysinfo', help='Print system information sampled by the server: CPU, load, memory,'
+                              ' network and battery')
+    v.set_defaults(q='sysinfo')
+
+    v = subparsers.add_parser('subscribe', help='Print a line of JSON every time one of the specified topics changes,'
+                              ' for status bars. Topics are: clock, sysinfo and vcs:/path/to/dir')
+    v.add_argument('topics', nargs='+', help='The topics to subscribe to')
+    v.set_defaults(q='subscribe')
+
+    v = subparsers.add_parser('chpwd', help='Tell the server that the shell has changed directory, so that it can start'
+                              ' fetching VCS data for it in the background. Does not wait for a reply.')
+    v.add_argument('path', nargs='?', help='The new working directory, defaults to the current directory')
+    v.set_defaults(q='chpwd')
+
+    v = subparsers.add_parser('shell', help='Print shell code that sets the prompt by querying the server directly,'
+                              ' without starting python for every prompt. Use it as: eval "$(watcher client shell)"')
+    v.add_argument('shell', nargs='?', default='zsh', choices=('zsh',), help='The shell to generate code for')
+    v.set_defaults(q='shell')
+
     return parser
 
 
@@ -3,7 +3,9 @@
 # License: GPL v3 Copyright: 2016, Kovid Goyal <kovid at kovidgoyal.net>
 
 import os
+from collections import OrderedDict
 
+from . import stats
 from .constants import (LEFT_DIVIDER, LEFT_END, RIGHT_END, VCS_SYMBOL,
                         ansi_code, bg, fg, hostname)
 from .vcs import vcs_data
@@ -24,24 +26,43 @@ HELLIPSIS = '⋯'
 IGNORE_USER = 'kovid'
 
 
+class Theme:
+
+    ''' The escape codes used by the prompt segments, computed once from the
+    color constants above, so that rendering a prompt is only concatenation
+    of these with the dynamic text. Re-create it if the colors are changed. '''
+
+    def __init__(self):
+        follow_on_bgs = (USER_BACKGROUND, CWD_BACKGROUND, CWD_LAST_BG)
+        self.vcs = {
+            dirty: ansi_code(fg(VCS_BACKGROUND)) + RIGHT_END + ansi_code(
+                bg(VCS_BACKGROUND), fg(VCS_DIRTY_FOREGROUND if dirty else VCS_FOREGROUND)) + '\xa0{}\xa0'.format(VCS_SYMBOL)
+            for dirty in (False, True)}
+        self.error = ansi_code(fg(ERROR_BACKGROUND)) + RIGHT_END + ansi_code(bg(ERROR_BACKGROUND), fg(ERROR_FOREGROUND)) + '\xa0'
+        self.hostname = {
+            b: ansi_code(fg(HOSTNAME_FOREGROUND), bg(HOSTNAME_BACKGROUND)) + '\xa0{}\xa0'.format(hostname()) +
+            ansi_code(fg(HOSTNAME_BACKGROUND), bg(b)) + LEFT_END for b in follow_on_bgs}
+        self.user_start = ansi_code(fg(USER_FOREGROUND), bg(USER_BACKGROUND)) + '\xa0'
+        self.user_end = {b: '\xa0' + ansi_code(fg(USER_BACKGROUND), bg(b)) + LEFT_END for b in follow_on_bgs}
+        self.cwd_start = ansi_code(fg(CWD_FOREGROUND), bg(CWD_BACKGROUND))
+        self.cwd_last_start = ansi_code(fg(CWD_LAST_FG), bg(CWD_LAST_BG)) + '\xa0'
+        self.cwd_last_end = '\xa0' + ansi_code('reset', fg(CWD_LAST_BG)) + LEFT_END
+        self.cwd_second_last_end = '\xa0' + ansi_code(fg(CWD_BACKGROUND), bg(CWD_LAST_BG)) + LEFT_END
+        self.cwd_divider = '\xa0' + LEFT_DIVIDER
+        self.reset = ansi_code('reset')
+
+
+theme = Theme()
+
+
 def vcs_segment(vcs_data, parts):
     if vcs_data['branch']:
-        a = parts.append
-        a(ansi_code(fg(VCS_BACKGROUND)))
-        a(RIGHT_END)
-        a(ansi_code(bg(VCS_BACKGROUND), (fg(VCS_DIRTY_FOREGROUND) if vcs_data['repo_status'] else fg(VCS_FOREGROUND))))
-        a('\xa0{}\xa0'.format(VCS_SYMBOL))
-        a(vcs_data['branch'])
-        a('\xa0')
+        parts.append(theme.vcs[bool(vcs_data['repo_status'])] + vcs_data['branch'] + '\xa0')
 
 
 def error_segment(err, parts):
     if err:
-        a = parts.append
-        a(ansi_code(fg(ERROR_BACKGROUND)))
-        a(RIGHT_END)
-        a(ansi_code(bg(ERROR_BACKGROUND), fg(ERROR_FOREGROUND)))
-        a('\xa0{}\xa0'.format(err))
+        parts.append(theme.error + '{}\xa0'.format(err))
 
 
 def safe_int(x):
@@ -51,53 +72,40 @@ def safe_int(x):
         return 0
 
 
-def right_prompt(cwd, last_exit_code, last_pipe_code):
+def right_prompt(cwd, last_exit_code, last_pipe_code, vcs=None):
     parts = []
     last_exit_code = safe_int(last_exit_code)
     last_pipe_code = safe_int(last_pipe_code)
     err = last_exit_code if last_exit_code != 0 else last_pipe_code if last_pipe_code != 0 else 0
     error_segment(err, parts)
-    vcs = vcs_data(cwd)
+    if vcs is None:
+        vcs = vcs_data(cwd)
     vcs_segment(vcs, parts)
     parts.insert(0, '\xa0')
     return parts
 
 
 def hostname_segment(parts, follow_on_bg):
-    a = parts.append
-    a(ansi_code(fg(HOSTNAME_FOREGROUND), bg(HOSTNAME_BACKGROUND)))
-    a('\xa0{}\xa0'.format(hostname()))
-    a(ansi_code(fg(HOSTNAME_BACKGROUND), bg(follow_on_bg)))
-    a(LEFT_END)
+    parts.append(theme.hostname[follow_on_bg])
 
 
 def user_segment(user, parts):
-    a = parts.append
-    a(ansi_code(fg(USER_FOREGROUND), bg(USER_BACKGROUND)))
-    a('\xa0{}\xa0'.format(user))
-    a(ansi_code(fg(USER_BACKGROUND), bg(cwd_segment.first_bg)))
-    a(LEFT_END)
+    parts.append(theme.user_start + user + theme.user_end[cwd_segment.first_bg])
 
 
 def cwd_segment(cwd_parts):
-    parts = []
+    t = theme
+    parts = [t.cwd_start]
     a = parts.append
-    a(ansi_code(fg(CWD_FOREGROUND), bg(CWD_BACKGROUND)))
     last = cwd_parts[-1]
     second_last = cwd_parts[-2] if len(cwd_parts) > 1 else None
     for p in cwd_parts:
         if p is last:
-            a(ansi_code(fg(CWD_LAST_FG), bg(CWD_LAST_BG)))
-        a('\xa0{}\xa0'.format(p))
-        if p is last:
-            a(ansi_code('reset', fg(CWD_LAST_BG)))
-            a(LEFT_END)
+            a(t.cwd_last_start + p + t.cwd_last_end)
+        elif p is second_last:
+            a('\xa0' + p + t.cwd_second_last_end)
         else:
-            if p is second_last:
-                a(ansi_code(fg(CWD_BACKGROUND), bg(CWD_LAST_BG)))
-                a(LEFT_END)
-            else:
-                a(LEFT_DIVIDER)
+            a('\xa0' + p + t.cwd_divider)
         if p is cwd_parts[0]:
             cwd_segment.first_bg = CWD_LAST_BG if p is last else CWD_BACKGROUND
     return parts
@@ -132,11 +140,45 @@ def left_prompt(user, cwd, is_ssh, home):
     return parts
 
 
-def prompt_data(which='left', cwd=os.getcwd(), last_exit_code=0, last_pipe_code=0, is_ssh='0', user='', home='', **k):
+def prompt_data(which='left', cwd=os.getcwd(), last_exit_code=0, last_pipe_code=0, is_ssh='0', user='', home='', vcs=None, **k):
     user = user or os.environ.get('USER', os.path.basename(os.path.expanduser('~')))
     if which == 'right':
-        parts = right_prompt(cwd, last_exit_code, last_pipe_code)
+        parts = right_prompt(cwd, last_exit_code, last_pipe_code, vcs)
     else:
         parts = left_prompt(user, cwd, is_ssh == '1', home)
-    parts.append(ansi_code('reset'))
+    parts.append(theme.reset)
     return ''.join(parts)
+
+
+# Rendered prompts, as UTF-8 bytes, so that repeated requests with the same
+# inputs, such as pressing Enter in the same directory, need no rendering.
+# Right prompts are stored with the VCS watcher and the generation of its
+# data they were rendered from, and are valid only while that is current.
+rendered_prompts = OrderedDict()
+MAX_RENDERED_PROMPTS = 512
+
+
+def prompt_key(msg):
+    if msg.get('which') == 'right':
+        return 'right', msg.get('cwd'), msg.get('last_exit_code'), msg.get('last_pipe_code')
+    return 'left', msg.get('cwd'), msg.get('is_ssh'), msg.get('user'), msg.get('home')
+
+
+def cached_prompt(key, watcher):
+    x = rendered_prompts.get(key)
+    if x is not None:
+        w, generation, raw = x
+        if w is watcher and (w is None or (w.is_current and w.updated_generation == generation)):
+            rendered_prompts.move_to_end(key)
+            stats.increment('prompt_cache_hits')
+            return raw
+    stats.increment('prompt_cache_misses')
+
+
+def cache_prompt(key, watcher, raw):
+    if watcher is not None and not watcher.is_watched:
+        return
+    rendered_prompts[key] = watcher, (None if watcher is None else watcher.updated_generation), raw
+    rendered_prompts.move_to_end(key)
+    if len(rendered_prompts) > MAX_RENDERED_PROMPTS:
+        rendered_prompts.popitem(last=False)
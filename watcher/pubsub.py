@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import time
+
+from .sysinfo import sampler
+from .utils import chain_future, print_error, realpath
+from .vcs import change_listeners, resolve_repo_roots, vcs_data_async, watcher_for
+
+# Set by the server, called as notify(subscriber, topic) when the value of a
+# topic changes, for every subscriber of the topic
+notify = None
+# Map of topic name to Topic, only topics with subscribers exist
+topics = {}
+CLOCK_INTERVAL = 60
+
+
+class Topic:
+
+    ''' A value that subscribers are told about whenever it changes. Only the
+    latest value is kept, it is up to the subscriber to decide when to read
+    it, so slow subscribers simply skip intermediate values. '''
+
+    def __init__(self, name):
+        self.name = name
+        self.subscribers = set()
+        self.value = None
+
+    def publish(self, value):
+        if value is None or value == self.value:
+            return
+        self.value = value
+        for subscriber in tuple(self.subscribers):
+            notify(subscriber, self)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def timeout(self, now):
+        return None
+
+    def tick(self, now):
+        pass
+
+    def housekeeping(self):
+        pass
+
+
+class VCSTopic(Topic):
+
+    ''' The VCS state of the repository containing path, refreshed whenever
+    the watcher of the repository sees a change. Changes that happen while a
+    refresh is in flight cause a single refresh once it is done. '''
+
+    def __init__(self, name, path):
+        Topic.__init__(self, name)
+        self.path = path
+        self.root = None
+        self.in_flight = self.stale = self.stopped = False
+
+    def start(self):
+        self.refresh()
+
+    def stop(self):
+        self.stopped = True
+        self.listen(None)
+
+    def housekeeping(self):
+        # Keeps the watcher for the repository from being evicted as idle
+        # and picks up a watcher that was evicted anyway
+        self.refresh()
+
+    def listen(self, root):
+        if root != self.root:
+            if self.root is not None:
+                listeners = change_listeners.get(self.root, set())
+                listeners.discard(self.refresh)
+                if not listeners:
+                    change_listeners.pop(self.root, None)
+            if root is not None:
+                change_listeners.setdefault(root, set()).add(self.refresh)
+            self.root = root
+
+    def refresh(self):
+        if self.in_flight:
+            self.stale = True
+            return
+        self.in_flight, self.stale = True, False
+        chain_future(resolve_repo_roots((self.path,)), self.fetch).add_done_callback(self.refreshed)
+
+    def fetch(self, *a):
+        if self.stopped:
+            return
+        w = watcher_for(self.path)[0]
+        self.listen(None if w is None else w.path)
+        return vcs_data_async(self.path)
+
+    def refreshed(self, fut):
+        self.in_flight = False
+        if self.stopped:
+            return
+        if fut.exception() is not None:
+            print_error('Failed to get VCS data for {} with error: {}'.format(self.path, fut.exception()))
+        else:
+            data = fut.result()
+            self.publish({'path': self.path, 'branch': data.get('branch'), 'repo_status': data.get('repo_status')})
+        if self.stale:
+            self.refresh()
+
+
+class SysinfoTopic(Topic):
+
+    ' Every sample of system information, sampling continues while there are subscribers '
+
+    def start(self):
+        sampler.listeners.add(self.publish)
+        if sampler.latest is not None:
+            self.publish(sampler.latest)
+        sampler.query()
+
+    def stop(self):
+        sampler.listeners.discard(self.publish)
+
+    def housekeeping(self):
+        sampler.last_used = time.monotonic()
+
+
+class ClockTopic(Topic):
+
+    ' The time, published at the start of every minute '
+
+    def start(self):
+        self.tick(time.monotonic())
+
+    def timeout(self, now):
+        return CLOCK_INTERVAL - time.time() % CLOCK_INTERVAL
+
+    def tick(self, now):
+        t = int(time.time())
+        t -= t % CLOCK_INTERVAL
+        if self.value is None or self.value['time'] != t:
+            self.publish({'time': t})
+
+
+def canonical_name(name):
+    ' Return the name used for the specified topic, raising ValueError for unknown topics '
+    if not isinstance(name, str):
+        raise ValueError('Unknown topic: {!r}'.format(name))
+    if name.startswith('vcs:') and len(name) > 4:
+        return 'vcs:' + realpath(name[4:])
+    if name in ('clock', 'sysinfo'):
+        return name
+    raise ValueError('Unknown topic: {}'.format(name))
+
+
+def subscribe(subscriber, name):
+    ''' Subscribe to the topic with the specified canonical name. The
+    subscriber is notified of the current value, if there is one. '''
+    topic = topics.get(name)
+    if topic is None:
+        if name.startswith('vcs:'):
+            topic = VCSTopic(name, name[4:])
+        else:
+            topic = (ClockTopic if name == 'clock' else SysinfoTopic)(name)
+        topics[name] = topic
+        topic.subscribers.add(subscriber)
+        topic.start()
+    elif subscriber not in topic.subscribers:
+        topic.subscribers.add(subscriber)
+        if topic.value is not None:
+            notify(subscriber, topic)
+    return topic
+
+
+def unsubscribe(subscriber, name):
+    topic = topics.get(name)
+    if topic is not None:
+        topic.subscribers.discard(subscriber)
+        if not topic.subscribers:
+            del topics[name]
+            topic.stop()
+
+
+def timeout(now):
+    ' The time till the next timed publication, or None '
+    ans = None
+    for topic in topics.values():
+        t = topic.timeout(now)
+        if t is not None and (ans is None or t < ans):
+            ans = t
+    return ans
+
+
+def tick(now):
+    for topic in tuple(topics.values()):
+        topic.tick(now)
+
+
+def housekeeping():
+    for topic in tuple(topics.values()):
+        topic.housekeeping()
+
+
+def stats():
+    return {
+        'topics': len(topics),
+        'subscriptions': sum(len(t.subscribers) for t in topics.values()),
+    }
@@ -8,105 +8,515 @@ import re
 import socket
 import signal
 import time
-import select
+import selectors
 import errno
 import traceback
+from concurrent.futures import Future
+from functools import partial
 
 from .constants import local_socket_address
-from .utils import deserialize_message, serialize_message, String, readlines, print_error
-from .vcs import vcs_data
-from .prompt import prompt_data
+from .utils import (
+    deserialize_message, serialize_message, String, readlines, print_error, raise_fd_limit,
+    FRAMED_MAGIC, parse_frames, serialize_frame, serialize_vcs, chain_future, gather_futures
+)
+from . import board, inotify, pubsub, stats, tree, vcs, workers
+from .sysinfo import sampler, sysinfo
+from .tree import tree_changed
+from .vcs import get_gsd, prewarm, resolve_repo_roots, vcs_data_async, vcs_data_batch_async, watcher_for
+from .prompt import prompt_data, prompt_key, cached_prompt, cache_prompt
 
-read_needed, write_needed = set(), set()
+# Uses epoll on Linux, so the cost of a wakeup does not depend on the number
+# of connected clients
+selector = selectors.DefaultSelector()
 clients = {}
+HOUSEKEEPING_INTERVAL = 60
+# All reads from clients go into this buffer, so that no new buffer is
+# allocated for every read
+read_buffer = bytearray(64 * 1024)
 
 
-def handle_msg(msg):
+def render_prompt(msg, key, watcher, vcs=None):
+    try:
+        ans = prompt_data(vcs=vcs, **msg).encode('utf-8')
+    except Exception as err:
+        print_error(traceback.format_exc())
+        return String(err)
+    cache_prompt(key, watcher, ans)
+    return ans
+
+
+def prompt_reply(msg):
+    key = prompt_key(msg)
+    if msg.get('which') == 'right':
+        w = watcher_for(msg['cwd'])[0]
+        ans = cached_prompt(key, w)
+        if ans is None and w is not None and msg.get('stale') in ('1', True) and w.updated_generation > -1:
+            # Render with the last known data right away and refresh it in
+            # the background for the next prompt
+            ans = render_prompt(msg, key, w, w.current_data((None,))[0])
+            prewarm(msg['cwd'])
+        elif ans is None:
+            ans = chain_future(vcs_data_async(msg['cwd']), partial(render_prompt, msg, key, w), prompt_error)
+        return ans
+    ans = cached_prompt(key, None)
+    if ans is None:
+        ans = render_prompt(msg, key, None)
+    return ans
+
+
+def prompt_line(ans):
+    return (ans if isinstance(ans, bytes) else ans.encode('utf-8')) + b'\n'
+
+
+def async_prompt_reply(msg):
+    ''' The right prompt rendered without VCS data right away, followed by the
+    full prompt once the VCS data is ready, each on its own line. If the VCS
+    data is already available, there is only the full prompt. '''
+    ready = resolve_repo_roots(query_paths(msg))
+    if ready.done():
+        ans = prompt_reply(msg)
+    else:
+        # Finding the repository root happens in a worker thread, the first
+        # line must not wait for it
+        ans = chain_future(ready, lambda x: prompt_reply(msg), prompt_error)
+    if not isinstance(ans, Future):
+        return [prompt_line(ans)]
+    if ans.done():
+        return [chain_future(ans, prompt_line)]
+    try:
+        first = prompt_data(vcs={'branch': None}, **msg)
+    except Exception as err:
+        print_error(traceback.format_exc())
+        first = String(err)
+    return [prompt_line(first), chain_future(ans, prompt_line)]
+
+
+def prompt_error(err):
+    print_error('Failed to get VCS data for prompt with error:', err)
+    return String(err)
+
+
+def vcs_reply(compact, ans):
+    if compact:
+        return serialize_vcs((ans,))
+    ans['ok'] = True
+    return ans
+
+
+def vcs_batch_reply(compact, results):
+    if compact:
+        return serialize_vcs(results, batch=True)
+    return {'ok': True, 'results': results}
+
+
+def error_reply(err):
+    stats.increment('errors')
+    tb = ''.join(traceback.format_exception(type(err), err, err.__traceback__))
+    print_error(tb)
+    return {'ok': False, 'msg': str(err), 'tb': tb}
+
+
+def server_stats():
+    ans = stats.summary()
+    ans.update(vcs.stats())
+    ans.update(workers.stats())
+    ans.update(pubsub.stats())
+    ans.update({
+        'ok': True,
+        'watched_dirs': len(tree.watched_dirs),
+        'inotify_watches': 0 if inotify.notifier is None else len(inotify.notifier.watches),
+        'clients': len(clients),
+    })
+    return ans
+
+
+QUERIES = frozenset(('prompt', 'vcs', 'vcs_batch', 'chpwd', 'stats', 'watch', 'sysinfo', 'subscribe', 'unsubscribe'))
+
+
+def serve_msg(msg):
+    ' Call handle_msg() recording the time taken for the response to be ready '
+    started = time.monotonic()
+    q = msg.get('q')
+    name = 'query:{}'.format(q if isinstance(q, str) and q in QUERIES else 'unknown')
+    response = handle_msg(msg)
+    futures = [r for r in (response if isinstance(response, list) else (response,)) if isinstance(r, Future)]
+    if futures:
+        gather_futures(futures).add_done_callback(lambda fut: stats.record(name, time.monotonic() - started))
+    else:
+        stats.record(name, time.monotonic() - started)
+    return response
+
+
+def serve_client_msg(msg):
+    ' Like serve_msg() but malformed messages get an error reply instead of raising '
+    if not isinstance(msg, dict):
+        return {'ok': False, 'msg': 'Messages must be JSON objects', 'tb': ''}
+    try:
+        return serve_msg(msg)
+    except Exception as err:
+        return error_reply(err)
+
+
+def query_paths(msg):
+    ' The paths whose repository roots are needed to answer msg '
+    q = msg.get('q')
+    if q in ('vcs', 'chpwd') or (q == 'prompt' and msg.get('which') == 'right'):
+        return (msg.get('path') or msg['cwd'],)
+    if q == 'vcs_batch':
+        return (path for path, subpath in msg['queries'])
+    return ()
+
+
+def handle_msg(msg, roots_resolved=False):
+    ''' Return the response to msg. Queries that need to wait for gitstatusd
+    return a Future instead, the response is sent when it completes. Queries
+    can also return a list of responses, which are sent one after the other,
+    all with the same request id in framed mode. '''
     q = msg.get('q')
     try:
+        if q == 'prompt' and msg.get('which') == 'right' and msg.get('async') in ('1', True):
+            return async_prompt_reply(msg)
+        ready = None if roots_resolved else resolve_repo_roots(query_paths(msg))
+        if ready is not None and not ready.done():
+            # Finding the repository roots needs file system access, which
+            # happens in worker threads, handle the query once that is done
+            if q == 'chpwd':
+                ready.add_done_callback(lambda fut: prewarm(msg['cwd']))
+                return {'ok': True}
+            return chain_future(ready, lambda x: handle_msg(msg, roots_resolved=True))
         if q == 'prompt':
-            try:
-                return String(prompt_data(**msg))
-            except Exception as err:
-                print_error(traceback.format_exc())
-                return String(err)
+            return prompt_reply(msg)
         if q == 'vcs':
-            ans = vcs_data(msg['path'], subpath=msg.get('subpath'), both=msg.get('both', False))
-            ans['ok'] = True
-            return ans
+            return chain_future(vcs_data_async(msg['path'], subpath=msg.get('subpath'), both=msg.get('both', False)),
+                                partial(vcs_reply, msg.get('compact')))
+        if q == 'vcs_batch':
+            return chain_future(vcs_data_batch_async(msg['queries']), partial(vcs_batch_reply, msg.get('compact')))
+        if q == 'chpwd':
+            # Sent when the shell changes directory, nobody waits for the reply
+            prewarm(msg['cwd'])
+            return {'ok': True}
+        if q == 'stats':
+            return server_stats()
+        if q == 'sysinfo':
+            return sysinfo()
+        if q == 'watch':
+            return chain_future(tree_changed(msg['path'], msg.get('token')), lambda ans: dict(ans, ok=True))
+        if q in ('subscribe', 'unsubscribe'):
+            # Handled by process_frames() as these need the connection
+            return {'ok': False, 'msg': 'The {} query needs a framed connection'.format(q), 'tb': ''}
     except Exception as err:
-        print_error(traceback.format_exc())
-        return {'ok': False, 'msg': str(err), 'tb': traceback.format_exc()}
+        return error_reply(err)
 
     return {'ok': False, 'msg': 'Query: {} not understood'.format(q), 'tb': ''}
 
 
-def tick(serversocket):
+def subscribe(c, request_id, msg):
+    ''' Subscribe the client to msg['topics']. The reply is followed by a
+    message with the same request id whenever a topic changes, of the form:
+    {'topic': name, 'data': value}. '''
     try:
-        readable, writable, _ = select.select([serversocket] + list(read_needed), list(write_needed), [])
-    except ValueError:
-        print_error('Listening socket was unexpectedly terminated')
-        raise SystemExit(1)
-    for s in readable:
-        if s is serversocket:
-            try:
-                c = s.accept()[0]
-            except socket.error:
-                pass
-            else:
-                read_needed.add(c)
-                clients[c] = {'rbuf': b''}
-        else:
-            c = s
-            data = clients.get(c)
-            if data is None:
-                c.close()
-                readable.discard(c)
-                continue
-            d = c.recv(4096)
-            if d:
-                data['rbuf'] += d
-            else:
-                read_needed.discard(c)
-                try:
-                    msg = deserialize_message(data.pop('rbuf'))
-                except Exception:
-                    del clients[c]
-                    c.close()
-                    continue
-                try:
-                    data['wbuf'] = serialize_message(handle_msg(msg))
-                except Exception:
-                    del clients[c]
-                    c.close()
-                else:
-                    write_needed.add(c)
-
-    for c in writable:
-        data = clients.get(c)
-        if data is None:
-            writable.discard(c)
-            c.close()
-            continue
-        try:
-            n = c.send(data['wbuf'])
-        except BrokenPipeError:
-            data['wbuf'] = b''
-            n = 0
-        if n > 0:
-            data['wbuf'] = data['wbuf'][n:]
+        names = [pubsub.canonical_name(name) for name in msg['topics']]
+    except (KeyError, TypeError, ValueError) as err:
+        return queue_response(c, request_id, {'ok': False, 'msg': 'Invalid topics: {}'.format(err), 'tb': ''})
+    queue_response(c, request_id, {'ok': True, 'topics': names})
+    subscriptions = clients[c]['subscriptions']
+    for name in names:
+        subscriptions.add((request_id, name))
+        pubsub.subscribe((c, request_id), name)
+
+
+def unsubscribe(c, request_id, msg):
+    ''' Remove the subscriptions of the client to msg['topics'], made by any request '''
+    try:
+        names = frozenset(pubsub.canonical_name(name) for name in msg['topics'])
+    except (KeyError, TypeError, ValueError) as err:
+        return queue_response(c, request_id, {'ok': False, 'msg': 'Invalid topics: {}'.format(err), 'tb': ''})
+    data = clients[c]
+    for sub in tuple(data['subscriptions']):
+        if sub[1] in names:
+            data['subscriptions'].discard(sub)
+            data['dirty'].pop(sub, None)
+            pubsub.unsubscribe((c, sub[0]), sub[1])
+    queue_response(c, request_id, {'ok': True})
+
+
+def topic_changed(subscriber, topic):
+    c, request_id = subscriber
+    data = clients.get(c)
+    if data is not None:
+        key = request_id, topic.name
+        if key in data['dirty']:
+            stats.increment('pubsub_coalesced')
+        data['dirty'][key] = topic
         if not data['wbuf']:
-            write_needed.discard(c)
-            c.close()
-            del clients[c]
+            flush_subscriptions(c)
 
 
-def run_loop(serversocket):
+def flush_subscriptions(c):
+    ''' Queue the latest values of the changed topics the client is
+    subscribed to. Only called once everything queued before has been sent, so
+    a slow client gets the latest value instead of a backlog of stale ones. '''
+    data = clients[c]
+    dirty, data['dirty'] = data['dirty'], {}
+    for (request_id, name), topic in dirty.items():
+        stats.increment('pubsub_messages')
+        queue_response(c, request_id, {'topic': name, 'data': topic.value})
+
+
+pubsub.notify = topic_changed
+
+
+def accept_clients(serversocket, events):
+    # Accept everything that is pending, so that a burst of connections
+    # costs a single wakeup
     while True:
         try:
-            tick(serversocket)
-        except KeyboardInterrupt:
-            raise SystemExit(0)
+            c = serversocket.accept()[0]
+        except (BlockingIOError, InterruptedError):
+            break
+        except OSError as err:
+            if err.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM, errno.ECONNABORTED):
+                print_error('Failed to accept connection with error:', err)
+                break
+            print_error('Listening socket was unexpectedly terminated')
+            raise SystemExit(1)
+        c.setblocking(False)
+        clients[c] = {'rbuf': bytearray(), 'wbuf': bytearray(), 'framed': None, 'eof': False, 'events': selectors.EVENT_READ, 'pending': 0,
+                      'subscriptions': set(), 'dirty': {}}
+        selector.register(c, selectors.EVENT_READ, client_ready)
+
+
+def drop_subscriptions(c, data):
+    for request_id, name in data['subscriptions']:
+        pubsub.unsubscribe((c, request_id), name)
+    data['subscriptions'].clear(), data['dirty'].clear()
+
+
+def close_client(c):
+    data = clients.pop(c, None)
+    if data is not None:
+        drop_subscriptions(c, data)
+    try:
+        selector.unregister(c)
+    except (KeyError, ValueError):
+        pass
+    c.close()
+
+
+def client_ready(c, events):
+    if events & selectors.EVENT_READ:
+        read_from_client(c)
+    if events & selectors.EVENT_WRITE and c in clients:
+        write_to_client(c)
+
+
+def update_interest(c):
+    data = clients[c]
+    events = 0 if data['eof'] else selectors.EVENT_READ
+    if data['wbuf']:
+        events |= selectors.EVENT_WRITE
+    if not events and not data['pending']:
+        return close_client(c)
+    if events != data['events']:
+        if not events:
+            selector.unregister(c)
+        elif not data['events']:
+            selector.register(c, events, client_ready)
+        else:
+            selector.modify(c, events, client_ready)
+        data['events'] = events
+
+
+def queue_response(c, request_id, response):
+    data = clients.get(c)
+    if data is None:
+        return  # The client has gone away
+    if isinstance(response, list):
+        for r in response:
+            queue_response(c, request_id, r)
+        return
+    if isinstance(response, Future):
+        # Park the request till the response is ready, other requests are
+        # served in the meantime
+        data['pending'] += 1
+        response.add_done_callback(partial(response_ready, c, request_id))
+        if c in clients:
+            update_interest(c)
+        return
+    try:
+        if data['framed']:
+            serialize_frame(request_id, response, data['wbuf'])
+        else:
+            data['wbuf'] += serialize_message(response)
+    except Exception:
+        return close_client(c)
+    update_interest(c)
+
+
+def response_ready(c, request_id, fut):
+    data = clients.get(c)
+    if data is not None:
+        data['pending'] -= 1
+        err = fut.exception()
+        queue_response(c, request_id, error_reply(err) if err is not None else fut.result())
+
+
+def read_from_client(c):
+    data = clients[c]
+    try:
+        n = c.recv_into(read_buffer)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        return close_client(c)
+    if n:
+        with memoryview(read_buffer) as m:
+            data['rbuf'] += m[:n]
+        if data['framed'] is None and len(data['rbuf']) >= len(FRAMED_MAGIC):
+            data['framed'] = data['rbuf'].startswith(FRAMED_MAGIC)
+            if data['framed']:
+                del data['rbuf'][:len(FRAMED_MAGIC)]
+        if data['framed']:
+            process_frames(c, data)
+        return
+    data['eof'] = True
+    if not data['framed']:
+        # Legacy mode, the request is everything sent before EOF
+        try:
+            msg = deserialize_message(data.pop('rbuf'))
+        except Exception:
+            return close_client(c)
+        return queue_response(c, 0, serve_client_msg(msg))
+    # Subscriptions last as long as the client keeps its end open
+    drop_subscriptions(c, data)
+    update_interest(c)
+
+
+def process_frames(c, data):
+    try:
+        frames = parse_frames(data['rbuf'])
+        msgs = [(request_id, deserialize_message(payload)) for request_id, payload in frames]
+    except Exception:
+        return close_client(c)
+    for request_id, msg in msgs:
+        if c not in clients:
+            return
+        q = msg.get('q') if isinstance(msg, dict) else None
+        if q in ('subscribe', 'unsubscribe'):
+            try:
+                (subscribe if q == 'subscribe' else unsubscribe)(c, request_id, msg)
+            except Exception as err:
+                queue_response(c, request_id, error_reply(err))
+        else:
+            queue_response(c, request_id, serve_client_msg(msg))
+    if c in clients:
+        update_interest(c)
+
+
+def write_to_client(c):
+    data = clients[c]
+    try:
+        n = c.send(data['wbuf'])
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        return close_client(c)
+    if n > 0:
+        # Removing from the front of a bytearray does not copy the remainder
+        del data['wbuf'][:n]
+        if not data['wbuf'] and data['dirty']:
+            flush_subscriptions(c)
+            if c not in clients:
+                return
+    update_interest(c)
+
+
+def housekeeping():
+    for registry in (vcs.watched_trees, tree.watched_dirs):
+        registry.evict_idle()
+        registry.evict_failed()
+    vcs.prune_repo_root_watches()
+    pubsub.housekeeping()
+    board.heartbeat()
+
+
+def tick():
+    now = time.monotonic()
+    if now - tick.last_housekeeping >= HOUSEKEEPING_INTERVAL:
+        tick.last_housekeeping = now
+        housekeeping()
+    timeouts = [t for t in (sampler.timeout(now), pubsub.timeout(now)) if t is not None]
+    ready = selector.select(min(timeouts + [HOUSEKEEPING_INTERVAL]))
+    now = time.monotonic()
+    sampler.tick(now)
+    pubsub.tick(now)
+    if inotify.notifier is not None:
+        # Process pending file system events before serving requests, so that
+        # responses reflect changes made before the requests were sent
+        inotify.notifier.read_events()
+    for key, events in ready:
+        key.data(key.fileobj, events)
+
+
+tick.last_housekeeping = time.monotonic()
+
+
+def create_notifier():
+    try:
+        inotify.notifier = inotify.INotify()
+    except Exception as err:
+        print_error('Failed to initialize inotify, changes to the file system will not be tracked. Error:', err)
+    return inotify.notifier
+
+
+def workers_ready(pool, events):
+    pool.process_results()
+
+
+def gsd_ready(fd, events):
+    if not get_gsd().read_responses():
+        # gitstatusd has died, it is restarted on the next request
+        selector.unregister(fd)
+
+
+def gsd_stopped(gsd):
+    # gitstatusd can be restarted before its death is noticed by gsd_ready()
+    try:
+        selector.unregister(gsd.fileno())
+    except (KeyError, ValueError):
+        pass
+
+
+def watch_gsd():
+    # Responses from gitstatusd are read in the loop, so requests waiting on
+    # it do not block anything else
+    gsd = get_gsd()
+    gsd.started_callback = lambda gsd: selector.register(gsd.fileno(), selectors.EVENT_READ, gsd_ready)
+    gsd.stopped_callback = gsd_stopped
+    gsd.started_callback(gsd)
+
+
+def run_loop(serversocket):
+    raise_fd_limit()
+    selector.register(serversocket, selectors.EVENT_READ, accept_clients)
+    notifier = create_notifier()
+    if notifier is not None:
+        selector.register(notifier, selectors.EVENT_READ, lambda n, events: n.read_events())
+    watch_gsd()
+    workers.pool = workers.WorkerPool()
+    selector.register(workers.pool, selectors.EVENT_READ, workers_ready)
+    if board.open_board() is not None:
+        sampler.listeners.add(board.sysinfo_updated)
+    # Exit cleanly on SIGTERM too, so that the board is removed
+    signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))
+    try:
+        while True:
+            try:
+                tick()
+            except KeyboardInterrupt:
+                raise SystemExit(0)
+    finally:
+        board.close_board()
 
 
 def daemonize(stdin=os.devnull, stdout=os.devnull, stderr=os.devnull):
@@ -191,6 +601,10 @@ def run_server(args):
         return check_accepting_connections()
     if args.daemonize:
         daemonize(stdout=args.log, stderr=args.log)
+    run_loop(create_server_socket())
+
+
+def create_server_socket():
     serversocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
         serversocket.bind(local_socket_address())
@@ -199,5 +613,5 @@ def run_server(args):
             raise SystemExit('The daemon is already running')
         raise
     serversocket.setblocking(0)
-    serversocket.listen(5)
-    run_loop(serversocket)
+    serversocket.listen(socket.SOMAXCONN)
+    return serversocket
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import shlex
+import sys
+
+from .constants import local_socket_address
+
+# Shell code that queries the daemon for the prompts directly, using socat to
+# talk to the abstract socket, so that no python interpreter is started for
+# every prompt. Messages are in the legacy format: a single leading byte
+# followed by key:value pairs separated by NUL bytes, terminated by EOF. When
+# socat is not available, it falls back to the python client.
+ZSH_TEMPLATE = '''\
+_watcher_prompt() {
+    # Arguments: which, cwd, last exit code, last pipe code
+    if (( $+commands[socat] )); then
+        print -rn -- $'\\0q:prompt\\0which:'"$1"$'\\0cwd:'"$2"$'\\0last_exit_code:'"$3"$'\\0last_pipe_code:'"$4" |
+            socat -t 5 - ABSTRACT-CONNECT:%(address)s 2>/dev/null
+    else
+        %(python)s %(entry)s client prompt "$1" --cwd "$2" --last-exit-code "$3" --last-pipe-code "$4" 2>/dev/null
+    fi
+}
+
+_watcher_chpwd() {
+    # Fire and forget, so that the VCS data is ready by the time the prompt is drawn
+    if (( $+commands[socat] )); then
+        print -rn -- $'\\0q:chpwd\\0cwd:'"${PWD:A}" | socat -u - ABSTRACT-CONNECT:%(address)s 2>/dev/null &!
+    else
+        %(python)s %(entry)s client chpwd "${PWD:A}" 2>/dev/null &!
+    fi
+}
+
+_watcher_async_prompt() {
+    # Called by zle when the full right prompt arrives on the fd
+    local fd=$1 line
+    if IFS= read -r -u $fd line; then
+        RPS1=$line
+        zle reset-prompt
+    fi
+    zle -F $fd
+    exec {fd}<&-
+    (( fd == _watcher_fd )) && _watcher_fd=
+}
+
+_watcher_precmd() {
+    local exit_code=$? pipe_code=${pipestatus[1]} cwd=${PWD:A} left line query
+    left=$(_watcher_prompt left "$cwd" "$exit_code" "$pipe_code")
+    PS1=${left:-'%%~ %%# '}
+    if [[ -n $_watcher_fd ]]; then
+        # The full right prompt for the previous command never arrived
+        zle -F $_watcher_fd 2>/dev/null
+        exec {_watcher_fd}<&-
+        _watcher_fd=
+    fi
+    if (( $+commands[socat] )); then
+        # The server replies with the right prompt without VCS data at once,
+        # and sends the full prompt later, if the VCS data is not ready
+        query=$'\\0q:prompt\\0which:right\\0async:1\\0cwd:'"$cwd"
+        query+=$'\\0last_exit_code:'"$exit_code"$'\\0last_pipe_code:'"$pipe_code"
+        exec {_watcher_fd}< <(print -rn -- "$query" | socat -t 60 - ABSTRACT-CONNECT:%(address)s 2>/dev/null)
+        IFS= read -r -u $_watcher_fd line
+        RPS1=$line
+        zle -F $_watcher_fd _watcher_async_prompt
+    else
+        RPS1=$(_watcher_prompt right "$cwd" "$exit_code" "$pipe_code")
+    fi
+}
+
+autoload -Uz add-zsh-hook
+add-zsh-hook precmd _watcher_precmd
+add-zsh-hook chpwd _watcher_chpwd
+'''
+
+
+def zsh_integration():
+    base = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return ZSH_TEMPLATE % dict(
+        address=shlex.quote(local_socket_address()[1:].decode('utf-8')),
+        python=shlex.quote(sys.executable), entry=shlex.quote(base))
+
+
+def main(args):
+    sys.stdout.write(zsh_integration())
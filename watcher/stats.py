@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import resource
+import threading
+from collections import Counter, defaultdict, deque
+
+# Latency percentiles are computed over this many of the most recent samples
+SAMPLES = 1000
+counters = Counter()
+latencies = defaultdict(lambda: deque(maxlen=SAMPLES))
+# Counters are also incremented from worker threads
+lock = threading.Lock()
+CACHES = ('prompt_cache', 'repo_root_cache', 'vcs_data')
+
+
+def increment(name, amount=1):
+    with lock:
+        counters[name] += amount
+
+
+def record(name, seconds):
+    ' Record the time taken by an operation, also counting the operation '
+    with lock:
+        counters[name] += 1
+        latencies[name].append(seconds)
+
+
+def percentiles(samples, which=(50, 95, 99)):
+    s = sorted(samples)
+    return {'p{}'.format(p): round(1000 * s[min(len(s) - 1, len(s) * p // 100)], 3) for p in which}
+
+
+def hit_rate(name):
+    hits, misses = counters[name + '_hits'], counters[name + '_misses']
+    return round(hits / (hits + misses), 3) if hits + misses else None
+
+
+def rss():
+    ' The current resident set size of this process in bytes '
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def summary():
+    with lock:
+        samples = {name: tuple(s) for name, s in latencies.items()}
+        ans = {
+            'counters': dict(counters),
+            'cache_hit_rates': {name: hit_rate(name) for name in CACHES},
+        }
+    ans['latency_ms'] = {name: dict(count=counters[name], **percentiles(s)) for name, s in samples.items() if s}
+    ans['rss'] = rss()
+    ans['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    ans['pid'] = os.getpid()
+    return ans
@@ -7,10 +7,13 @@ import sys
 import os
 import vim
 import codecs
+import threading
+import time
 from collections import namedtuple
+from queue import Empty, SimpleQueue
 
 from .constants import LEFT_END, LEFT_DIVIDER, RIGHT_END, RIGHT_DIVIDER, VCS_SYMBOL, READONLY
-from .client import connect, send_msg, recv_msg
+from .client import Connection
 from .utils import realpath
 
 
@@ -30,6 +33,7 @@ hl_groups = {}
 
 def reset_highlights():
     hl_groups.clear()
+    rendered.clear()
 
 
 def highlight(fg=None, bg=None, bold=False):
@@ -177,7 +181,8 @@ def safe_int(x):
 
 
 def setup():
-    sys.statusline = namedtuple('StatusLine', 'render reset_highlights debug refresh')(statusline, reset_highlights, debug, refresh)
+    sys.statusline = namedtuple('StatusLine', 'render reset_highlights debug refresh process_vcs_results')(
+        statusline, reset_highlights, debug, refresh, process_vcs_results)
     vim.command('''
 function g:StatusLine_render(winid)
     let winnr = win_id2win(a:winid)
@@ -217,33 +222,52 @@ function g:StatusLine_get_data(winnr)
     let name = bufname(cbufnr)
     let file_directory = name != '' ? fnamemodify(name, ':~:.:h') : ''
     let file_name = name != '' ? fnamemodify(name, ':~:.:t') : ''
-    if has('nvim')
-        let errors += luaeval('#vim.diagnostic.get(0, {severity = vim.diagnostic.severity.ERROR})')
-        let warnings += luaeval('#vim.diagnostic.get(0, {severity = vim.diagnostic.severity.WARN})')
-    else
-        try
-            let l:counts = ale#statusline#Count(bufnr(''))
-            if l:counts.total > 0
-                let errors += l:counts.error + l:counts.style_error
-                let warnings += l:counts.warning + l:counts.style_warning
+    " Diagnostics are stored in the buffer, along with the changedtick they
+    " were computed at, and re-used for non-current windows showing the
+    " buffer if it has not changed since
+    let tick = getbufvar(cbufnr, 'changedtick')
+    let diagnostics = getbufvar(cbufnr, 'statusline_diagnostics', [])
+    if a:winnr == winnr() || empty(diagnostics) || diagnostics[0] != tick
+        if has('nvim')
+            let errors += luaeval('#vim.diagnostic.get(_A, {severity = vim.diagnostic.severity.ERROR})', cbufnr)
+            let warnings += luaeval('#vim.diagnostic.get(_A, {severity = vim.diagnostic.severity.WARN})', cbufnr)
+        else
+            try
+                let l:counts = ale#statusline#Count(cbufnr)
+                if l:counts.total > 0
+                    let errors += l:counts.error + l:counts.style_error
+                    let warnings += l:counts.warning + l:counts.style_warning
+                endif
+            catch /.*/
+            endtry
+            if a:winnr == winnr()
+                " Only works for the current buffer
+                try
+                    let errors += youcompleteme#GetErrorCount()
+                    let warnings += youcompleteme#GetWarningCount()
+                catch /.*/
+                endtry
             endif
-        catch /.*/
-        endtry
-        try
-            let errors += youcompleteme#GetErrorCount()
-            let warnings += youcompleteme#GetWarningCount()
-        catch /.*/
-        endtry
+        endif
+        call setbufvar(cbufnr, 'statusline_diagnostics', [tick, errors, warnings])
+    else
+        let errors = diagnostics[1]
+        let warnings = diagnostics[2]
     endif
     let ans = {'mode':m, 'bufname':name, 'file_directory':file_directory, 'file_name':file_name, \
         'readonly':getbufvar(cbufnr, "&readonly"), 'modified':getbufvar(cbufnr, "&modified"), \
         'buftype':getbufvar(cbufnr, "&buftype"), 'fileformat':getbufvar(cbufnr, '&fileformat'), \
         'fileencoding':getbufvar(cbufnr, '&fileencoding'), 'filetype':getbufvar(cbufnr, '&filetype'), \
-        'vstart':vstart, 'vend':vend, 'warnings': warnings, 'errors': errors \
+        'vstart':vstart, 'vend':vend, 'warnings': warnings, 'errors': errors, 'paste': &paste \
     }
     return ans
 endfunction ''')
 
+    vim.command('''
+function g:StatusLine_process_vcs_results(timer)
+    PYTHON sys.statusline.process_vcs_results()
+endfunction'''.replace('PYTHON', python))
+
     vim.command('augroup statusline')
     vim.command(f'	autocmd! ColorScheme * :{python} sys.statusline.reset_highlights()')
     vim.command(f'	autocmd! FocusGained * :{python} sys.statusline.refresh()')
@@ -308,7 +332,7 @@ def mode_segment():
     mode_name = mode_translations.get(current_mode, current_mode)
     ans = vim_modes.get(mode_name)
     if ans is not None:
-        p = 'PASTE' if int(vim.eval('&paste')) else None
+        p = 'PASTE' if int(statusline.data['paste']) else None
         if p:
             ans += ' [paste]'
         q = mode_name if mode_name in mode_colors else mode_name[0]
@@ -407,23 +431,86 @@ def file_status():
         return '\xa0' + d.rstrip()
 
 
+# VCS data is fetched by a background thread, so that rendering the
+# statusline never waits for the daemon. Rendering uses the last known data
+# for the buffer and queues a refresh, the answers are applied by a timer
+# that redraws the statuslines only if something changed. The timer only runs
+# while there are requests in flight, so that an idle vim is never woken up.
+vcs_cache = {}
+vcs_pending = set()
+vcs_requests = SimpleQueue()
+vcs_results = SimpleQueue()
+RETRY_INTERVAL = 5
+
+
 def fetch_vcs_data():
     name = statusline.data['bufname']
     fetch_vcs_data.repo_status = fetch_vcs_data.file_status = fetch_vcs_data.branch = None
     if name and not statusline.data['buftype']:
-        s = connect()
-        path = realpath(name)
-        both = not os.path.isdir(path)
-        subpath = None
-        if both:
-            subpath, path = path, os.path.dirname(path)
-        if not (subpath or '').startswith('.git/'):
-            send_msg(s, {'q': 'vcs', 'path': path, 'subpath': subpath, 'both': both})
-            ans = recv_msg(s)
-            if ans.get('ok'):
-                fetch_vcs_data.repo_status = ans.get('repo_status')
-                fetch_vcs_data.branch = ans.get('branch')
-                fetch_vcs_data.file_status = ans.get('file_status')
+        key = os.path.abspath(name)
+        fetch_vcs_data.branch, fetch_vcs_data.repo_status, fetch_vcs_data.file_status = vcs_cache.get(key, (None, None, None))
+        if key not in vcs_pending:
+            vcs_pending.add(key)
+            if vcs_worker.thread is None:
+                vcs_worker.thread = threading.Thread(target=vcs_worker, name='StatusLineVCS', daemon=True)
+                vcs_worker.thread.start()
+            vcs_requests.put(key)
+            if process_vcs_results.timer is None:
+                process_vcs_results.timer = int(vim.eval("timer_start(100, 'g:StatusLine_process_vcs_results', {'repeat': -1})"))
+
+
+def vcs_query(connection, name):
+    path = realpath(name)
+    both = not os.path.isdir(path)
+    subpath = None
+    if both:
+        subpath, path = path, os.path.dirname(path)
+    if (subpath or '').startswith('.git/'):
+        return {'ok': False}
+    return connection({'q': 'vcs', 'path': path, 'subpath': subpath, 'both': both, 'compact': True})
+
+
+def vcs_worker():
+    connection = Connection()
+    failed_at = None
+    while True:
+        key = vcs_requests.get()
+        ans = None
+        # Do not keep trying to connect to a daemon that is not running
+        if failed_at is None or time.monotonic() - failed_at > RETRY_INTERVAL:
+            try:
+                ans = vcs_query(connection, key)
+                failed_at = None
+            except Exception:
+                failed_at = time.monotonic()
+        vcs_results.put((key, ans))
+
+
+vcs_worker.thread = None
+
+
+def process_vcs_results():
+    changed = False
+    while True:
+        try:
+            key, ans = vcs_results.get_nowait()
+        except Empty:
+            break
+        vcs_pending.discard(key)
+        if ans is None:
+            continue  # the daemon could not be reached, keep the last known data
+        val = (ans.get('branch'), ans.get('repo_status'), ans.get('file_status')) if ans.get('ok') else (None, None, None)
+        if vcs_cache.get(key) != val:
+            vcs_cache[key] = val
+            changed = True
+    if not vcs_pending and process_vcs_results.timer is not None:
+        vim.command('call timer_stop({})'.format(process_vcs_results.timer))
+        process_vcs_results.timer = None
+    if changed:
+        refresh()
+
+
+process_vcs_results.timer = None
 
 
 def left():
@@ -507,6 +594,12 @@ right.segments = (file_format, file_encoding, file_type, line_percent, line_curr
 # }}}
 
 
+# Map of window number to the data used to render its statusline and the
+# result, the statusline depends on nothing else, so it is re-used while the
+# data is unchanged
+rendered = {}
+
+
 def statusline(winnr):
     ' The function responsible for rendering the statusline '
     global current_mode
@@ -514,9 +607,14 @@ def statusline(winnr):
         statusline.data = vim.eval(f'g:StatusLine_get_data({winnr})')
         current_mode = statusline.data['mode']
         fetch_vcs_data()
+        key = statusline.data, (fetch_vcs_data.branch, fetch_vcs_data.repo_status, fetch_vcs_data.file_status)
+        x = rendered.get(winnr)
+        if x is not None and x[0] == key:
+            return x[1]
         ans = left()
         ans += '%='  # left/right separator
         ans += right()
+        rendered[winnr] = key, ans
         return ans
     finally:
         current_mode = 'nc'
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import time
+
+from .battery import MovingAverage, battery_time
+from .utils import chain_future, print_error, resolved_future
+from .workers import run_blocking
+
+SAMPLE_INTERVAL = 2
+# Number of samples in the moving averages
+HISTORY = 30
+# Sampling stops if nobody has asked for system information for this long
+IDLE_TIMEOUT = 600
+
+
+def read_cpu_times():
+    ' Return the (busy, total) jiffies of all CPUs '
+    with open('/proc/stat', 'rb') as f:
+        fields = [int(x) for x in f.readline().split()[1:]]
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields[:8])  # guest time is already included in user time
+    return total - idle, total
+
+
+def read_loadavg():
+    with open('/proc/loadavg', 'rb') as f:
+        return [float(x) for x in f.read().split()[:3]]
+
+
+def read_memory():
+    ans = {}
+    with open('/proc/meminfo', 'rb') as f:
+        for line in f:
+            key, val = line.split(b':', 1)
+            if key in (b'MemTotal', b'MemAvailable'):
+                ans[key.decode('ascii')] = int(val.split()[0]) * 1024
+    return ans.get('MemTotal', 0), ans.get('MemAvailable', 0)
+
+
+def read_network():
+    ' Return the total bytes (received, sent) over all interfaces except loopback '
+    rx = tx = 0
+    with open('/proc/net/dev', 'rb') as f:
+        for line in f.readlines()[2:]:
+            name, data = line.split(b':', 1)
+            if name.strip() != b'lo':
+                fields = data.split()
+                rx += int(fields[0])
+                tx += int(fields[8])
+    return rx, tx
+
+
+def read_all():
+    ' Read all the counters, called in a worker thread, as reading battery data can be slow '
+    ans = {'at': time.monotonic()}
+    for key, func in (('cpu', read_cpu_times), ('load', read_loadavg), ('memory', read_memory), ('network', read_network), ('battery', battery_time)):
+        try:
+            ans[key] = func()
+        except Exception as err:
+            print_error('Failed to read {} information with error: {}'.format(key, err))
+            ans[key] = None
+    return ans
+
+
+class Sampler:
+
+    ''' Samples system information every SAMPLE_INTERVAL seconds, while it is
+    being used, keeping moving averages of the rates. The event loop calls
+    tick() and uses timeout() as the maximum time to wait. '''
+
+    def __init__(self):
+        self.cpu = MovingAverage(HISTORY)
+        self.rx, self.tx = MovingAverage(HISTORY), MovingAverage(HISTORY)
+        self.previous = self.latest = None
+        self.in_flight = None
+        self.last_used = 0
+        self.next_sample = 0
+        self.generation = 0
+        # Called with the processed data of every sample
+        self.listeners = set()
+
+    def timeout(self, now):
+        if now - self.last_used >= IDLE_TIMEOUT or self.in_flight is not None:
+            # The loop is woken up when the sample in flight is done
+            return None
+        return max(0, self.next_sample - now)
+
+    def tick(self, now):
+        if self.in_flight is None and now >= self.next_sample and now - self.last_used < IDLE_TIMEOUT:
+            self.sample(now)
+
+    def sample(self, now):
+        self.next_sample = now + SAMPLE_INTERVAL
+        self.in_flight = chain_future(run_blocking(None, read_all), self.add_sample)
+        self.in_flight.add_done_callback(self.sample_done)
+        return self.in_flight
+
+    def sample_done(self, fut):
+        self.in_flight = None
+        if fut.exception() is not None:
+            print_error('Failed to sample system information with error:', fut.exception())
+
+    def add_sample(self, raw):
+        prev, self.previous = self.previous, raw
+        ans = {'cpu_percent': None, 'net_rx_rate': None, 'net_tx_rate': None}
+        # Rates are not computed across periods when sampling was stopped
+        if prev is not None and raw['at'] - prev['at'] < 3 * SAMPLE_INTERVAL:
+            elapsed = raw['at'] - prev['at']
+            if raw['cpu'] and prev['cpu'] and raw['cpu'][1] > prev['cpu'][1]:
+                self.cpu.append(100 * (raw['cpu'][0] - prev['cpu'][0]) / (raw['cpu'][1] - prev['cpu'][1]))
+                ans['cpu_percent'] = round(self.cpu.latest, 1)
+            if raw['network'] and prev['network'] and elapsed > 0:
+                self.rx.append(max(0, raw['network'][0] - prev['network'][0]) / elapsed)
+                self.tx.append(max(0, raw['network'][1] - prev['network'][1]) / elapsed)
+                ans['net_rx_rate'], ans['net_tx_rate'] = round(self.rx.latest), round(self.tx.latest)
+        total, available = raw['memory'] or (0, 0)
+        ans.update({
+            'cpu_percent_avg': round(self.cpu.mean, 1) if len(self.cpu) else None,
+            'net_rx_rate_avg': round(self.rx.mean) if len(self.rx) else None,
+            'net_tx_rate_avg': round(self.tx.mean) if len(self.tx) else None,
+            'load': raw['load'],
+            'memory_total': total, 'memory_available': available,
+            'memory_percent': round(100 * (total - available) / total, 1) if total else None,
+            'battery': raw['battery'],
+            'sampled_at': time.time(), 'interval': SAMPLE_INTERVAL,
+        })
+        self.latest = ans
+        self.generation += 1
+        for listener in tuple(self.listeners):
+            listener(ans)
+        return ans
+
+    def query(self):
+        ' Return the latest system information, or a Future for it if nothing has been sampled yet '
+        now = time.monotonic()
+        self.last_used = now
+        if self.latest is not None and now - self.previous['at'] < 3 * SAMPLE_INTERVAL:
+            return resolved_future(self.latest)
+        return self.in_flight or self.sample(now)
+
+
+sampler = Sampler()
+
+
+def sysinfo():
+    return chain_future(sampler.query(), lambda x: dict(x, ok=True))
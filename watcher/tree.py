@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import time
+from itertools import count
+
+from . import inotify
+from .inotify import TreeWatcher
+from .utils import chain_future, realpath, resolved_future, WatcherRegistry
+
+# Tokens from a previous server instance must never match
+instance_id = '{:x}{:x}'.format(os.getpid(), time.monotonic_ns())
+tree_ids = count()
+
+
+class WatchedTree(TreeWatcher):
+
+    ''' Keep a generation counter for a directory tree that is incremented
+    whenever the kernel reports a change anywhere in the tree. Trees that
+    cannot be watched are always reported as changed. '''
+
+    # Files written to without being closed are changes too
+    events = inotify.TREE_EVENTS | inotify.IN_MODIFY
+
+    def __init__(self, path):
+        TreeWatcher.__init__(self, path)
+        self.tree_id = next(tree_ids)
+        self.generation = 0
+        self.start_watching()
+
+    def walk(self, tree_watch):
+        tree_watch.add_tree(self.path)
+
+    def tree_changed(self, path, name, mask):
+        self.generation += 1
+        if path == self.path and mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+            # The tree is gone, any future query must start afresh
+            watched_dirs.remove(self.path, self)
+
+    @property
+    def token(self):
+        if not self.is_watched:
+            return ''
+        return '{}:{}:{}'.format(instance_id, self.tree_id, self.generation)
+
+
+watched_dirs = WatcherRegistry(max_size=64, max_idle=3600)
+
+
+def tree_changed(path, token=None):
+    ' Return a Future that resolves to whether the tree at path has changed since token was issued and the current token '
+    path = realpath(path)
+    if not os.path.isdir(path):
+        raise NotADirectoryError('{} is not a directory'.format(path))
+    t = watched_dirs.get(path)
+    if t is None:
+        t = watched_dirs.add(path, WatchedTree(path))
+
+    def answer(*a):
+        current = t.token
+        return {'changed': not current or current != token, 'token': current}
+
+    if t.watching is not None and not t.watching.done():
+        return chain_future(t.watching, answer)
+    return resolved_future(answer())
@@ -6,10 +6,17 @@ from __future__ import print_function, unicode_literals, division
 import os
 import json
 import stat
+import struct
 import subprocess
 import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
 from math import log
 
+from . import stats
+
 
 class String(str):
     pass
@@ -24,6 +31,19 @@ def print_error(*args, **kw):
     print(*args, **kw)
 
 
+def raise_fd_limit():
+    # Every connected client needs a file descriptor
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1 << 16
+    if soft != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
 def ismount(path, stat_func=os.lstat):
     st = stat_func(path)
     if stat.S_ISLNK(st.st_mode):
@@ -74,6 +94,8 @@ def generate_directories(path):
 def deserialize_message(raw):
     if raw.startswith(b'\x01'):
         return json.loads(raw[1:].decode('utf-8'))
+    elif raw[:1] in (VCS_TAG, VCS_BATCH_TAG):
+        return deserialize_vcs(raw)
     else:
         raw = raw[1:].decode('utf-8')
         ans = {}
@@ -84,6 +106,8 @@ def deserialize_message(raw):
 
 
 def serialize_message(msg):
+    if isinstance(msg, bytes):
+        return msg  # already serialized
     if isinstance(msg, String):
         return msg.encode('utf-8')
     ans = json.dumps(msg, ensure_ascii=False).encode('utf-8')
@@ -91,7 +115,205 @@ def serialize_message(msg):
     return ans
 
 
+# Clients that want to keep a connection open and pipeline requests start by
+# sending FRAMED_MAGIC. After that every request and response is a frame: a
+# header with the payload length and the request id, followed by the payload,
+# which is a serialized message. Legacy clients instead send a single message
+# and signal its end with EOF. Legacy messages never start with FRAMED_MAGIC,
+# as that would mean an empty first key.
+FRAMED_MAGIC = b'\x02\x00'
+frame_header = struct.Struct('!II')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+def serialize_frame(request_id, msg, buf=None):
+    ''' Serialize msg as a frame, appending it to the bytearray buf, if
+    specified, to avoid copying the payload '''
+    payload = serialize_message(msg)
+    if buf is None:
+        return frame_header.pack(len(payload), request_id) + payload
+    buf += frame_header.pack(len(payload), request_id)
+    buf += payload
+    return buf
+
+
+def parse_frames(buf):
+    ''' Return the list of complete (request_id, payload) frames in the
+    bytearray buf, removing them from it '''
+    ans = []
+    pos, hsz = 0, frame_header.size
+    view = memoryview(buf)
+    try:
+        while len(buf) - pos >= hsz:
+            sz, request_id = frame_header.unpack_from(buf, pos)
+            if sz > MAX_FRAME_SIZE:
+                raise ValueError('Frame of size {} is too large'.format(sz))
+            if len(buf) - pos - hsz < sz:
+                break
+            ans.append((request_id, bytes(view[pos + hsz:pos + hsz + sz])))
+            pos += hsz + sz
+    finally:
+        view.release()
+    del buf[:pos]
+    return ans
+
+
+# A compact encoding for the results of VCS queries, used instead of JSON when
+# the query has compact set. A tag byte, followed by the fields of every
+# result, separated by NUL bytes. None is encoded as 0xff which never occurs
+# in UTF-8 text.
+VCS_TAG = b'\x03'
+VCS_BATCH_TAG = b'\x04'
+VCS_FIELDS = ('branch', 'repo_status', 'file_status')
+
+
+def serialize_vcs(results, batch=False):
+    fields = (b'\xff' if r.get(f) is None else r[f].encode('utf-8') for r in results for f in VCS_FIELDS)
+    return (VCS_BATCH_TAG if batch else VCS_TAG) + b'\0'.join(fields)
+
+
+def deserialize_vcs(raw):
+    fields = [None if x == b'\xff' else x.decode('utf-8') for x in raw[1:].split(b'\0')] if len(raw) > 1 else []
+    n = len(VCS_FIELDS)
+    results = [dict(zip(VCS_FIELDS, fields[i:i + n])) for i in range(0, len(fields), n)]
+    if raw[:1] == VCS_TAG:
+        ans = results[0]
+        ans['ok'] = True
+        return ans
+    return {'ok': True, 'results': results}
+
+
+class WatcherRegistry:
+
+    ''' A map of path to watcher objects that holds at most max_size entries,
+    evicting the least recently used ones. Entries not used for max_idle
+    seconds are removed by evict_idle(). The stop_watching() method of
+    removed watchers is called to release their resources. '''
+
+    def __init__(self, max_size, max_idle):
+        self.max_size, self.max_idle = max_size, max_idle
+        self.entries = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def watchers(self):
+        return (x[0] for x in self.entries.values())
+
+    def get(self, path):
+        x = self.entries.get(path)
+        if x is not None:
+            self.entries.move_to_end(path)
+            x[1] = time.monotonic()
+            return x[0]
+
+    def add(self, path, watcher):
+        self.remove(path)
+        self.entries[path] = [watcher, time.monotonic()]
+        while len(self.entries) > self.max_size:
+            self.evict(next(iter(self.entries)))
+        return watcher
+
+    def remove(self, path, watcher=None):
+        x = self.entries.get(path)
+        if x is not None and (watcher is None or x[0] is watcher):
+            del self.entries[path]
+            x[0].stop_watching()
+
+    def evict(self, path):
+        self.remove(path)
+        self.evicted += 1
+
+    def evict_idle(self, now=None):
+        limit = (time.monotonic() if now is None else now) - self.max_idle
+        while self.entries:
+            path, (watcher, last_used) = next(iter(self.entries.items()))
+            if last_used > limit:
+                break
+            self.evict(path)
+
+    def evict_failed(self):
+        ''' Remove watchers whose tree watch has failed, so that they are
+        created afresh, with a complete set of watches, when next used '''
+        for path, (watcher, last_used) in tuple(self.entries.items()):
+            if watcher.tree_watch is not None and watcher.tree_watch.failed:
+                self.evict(path)
+
+    def clear(self):
+        while self.entries:
+            self.remove(next(iter(self.entries)))
+
+
+def resolved_future(result=None):
+    ans = Future()
+    ans.set_result(result)
+    return ans
+
+
+def chain_future(fut, func, on_error=None):
+    ''' Return a Future that resolves to func(fut.result()). If fut fails, the
+    returned future fails too, unless on_error is specified, in which case it
+    resolves to on_error(exception). If func returns a Future, the returned
+    future resolves to its result. '''
+    ans = Future()
+
+    def done(fut):
+        try:
+            err = fut.exception()
+            if err is None:
+                result = func(fut.result())
+            elif on_error is None:
+                raise err
+            else:
+                result = on_error(err)
+        except Exception as e:
+            ans.set_exception(e)
+        else:
+            if isinstance(result, Future):
+                result.add_done_callback(forward)
+            else:
+                ans.set_result(result)
+
+    def forward(fut):
+        err = fut.exception()
+        if err is None:
+            ans.set_result(fut.result())
+        else:
+            ans.set_exception(err)
+
+    fut.add_done_callback(done)
+    return ans
+
+
+def gather_futures(futures):
+    ' Return a Future that resolves to the list of results of all the specified futures '
+    futures = tuple(futures)
+    ans = Future()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    if not futures:
+        ans.set_result(results)
+
+    def done(i, fut):
+        if ans.done():
+            return
+        err = fut.exception()
+        if err is not None:
+            ans.set_exception(err)
+            return
+        results[i] = fut.result()
+        remaining[0] -= 1
+        if not remaining[0]:
+            ans.set_result(results)
+
+    for i, fut in enumerate(futures):
+        fut.add_done_callback(partial(done, i))
+    return ans
+
+
 def readlines(cmd, cwd=None, decode=True):
+    stats.increment('subprocesses')
     p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
     p.stderr.close()
     with p.stdout:
@@ -102,6 +324,15 @@ def readlines(cmd, cwd=None, decode=True):
                 yield line[:-1]
 
 
+def readall(cmd, cwd=None):
+    stats.increment('subprocesses')
+    p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=cwd)
+    with p.stdout:
+        ans = p.stdout.read()
+    p.wait()
+    return ans
+
+
 unit_list = tuple(zip(['', 'k', 'M', 'G', 'T', 'P'], [0, 0, 1, 2, 2, 2]))
 
 
@@ -5,9 +5,19 @@
 
 import os
 import re
+import threading
+import time
+from functools import partial
 
-from .utils import generate_directories, realpath, readlines
+from .utils import (
+    generate_directories, realpath, readall, print_error,
+    chain_future, gather_futures, resolved_future, WatcherRegistry
+)
 from .gitstatusd import GSD
+from . import board, inotify
+from .stats import increment, record
+from .inotify import TreeWatcher
+from .workers import run_blocking
 
 
 # git {{{
@@ -16,15 +26,31 @@ from .gitstatusd import GSD
 gsd = None
 
 
-def gitcmd(directory, *args):
-    return readlines(('git',) + args, directory)
-
-
-def git_data(directory):
+def get_gsd():
     global gsd
     if gsd is None:
         gsd = GSD()
-    data = gsd(directory)
+    return gsd
+
+
+def git_data(directory):
+    started = time.monotonic()
+    try:
+        return summarize_git_data(get_gsd()(directory))
+    finally:
+        record('gitstatusd', time.monotonic() - started)
+
+
+def git_data_async(directory):
+    started = time.monotonic()
+
+    def done(data):
+        record('gitstatusd', time.monotonic() - started)
+        return summarize_git_data(data)
+    return chain_future(get_gsd().submit(directory), done)
+
+
+def summarize_git_data(data):
     branch_name = data['branch_name'] or data['HEAD'] or '-no-branch-'
     dirty = (
         data['num_unstaged_changes'] or data['num_staged_changes'] or data['num_untracked_files'] or
@@ -34,20 +60,90 @@ def git_data(directory):
     return branch_name, ('M' if dirty else '')
 
 
-def git_file_status(directory, subpath):
-    try:
-        return next(gitcmd(directory, 'status', '--porcelain', '--ignored', '--', subpath))[:2]
-    except StopIteration:
-        return ''
+def parse_porcelain(raw):
+    ' Parse the output of git status --porcelain=v2 -z into a map of path to the XY status used by --porcelain=v1 '
+    ans = {}
+    entries = iter(raw.split(b'\0'))
+    for entry in entries:
+        kind = entry[:1]
+        if kind in (b'?', b'!'):
+            ans[os.fsdecode(entry[2:])] = (kind * 2).decode('ascii')
+            continue
+        if kind == b'1':
+            parts = entry.split(b' ', 8)
+        elif kind == b'2':
+            parts = entry.split(b' ', 9)
+            next(entries, None)  # the original path
+        elif kind == b'u':
+            parts = entry.split(b' ', 10)
+        else:
+            continue
+        ans[os.fsdecode(parts[-1])] = parts[1].decode('ascii', 'replace').replace('.', ' ')
+    return ans
+
+
+def status_for(statuses, subpath):
+    ans = statuses.get(subpath)
+    parent = subpath
+    while ans is None:
+        # Untracked and ignored directories are reported as a single entry
+        parent = os.path.dirname(parent)
+        if not parent:
+            break
+        ans = statuses.get(parent + '/')
+    return ans or ''
+
+
+def git_status_map(directory):
+    ' Return the status of every file in the repository that is not clean '
+    # Do not let git refresh the index, that would be reported as a change to the tree
+    return parse_porcelain(readall((
+        'git', '--no-optional-locks', 'status', '--porcelain=v2', '-z', '--ignored=matching', '--untracked-files=normal'), directory))
 
 
 def git_ignore_modified(path, name):
-    return path.endswith('.git') and name == 'index.lock'
+    # gitstatusd creates temporary .gitstatus.* directories in the git dir to
+    # check if mtimes are reliable
+    return path.endswith('.git') and (name == 'index.lock' or name.startswith('.gitstatus.'))
+
+
+def git_prune(parent, name):
+    return name == '.git'
+
+
+def git_dir(directory):
+    ans = os.path.join(directory, '.git')
+    if os.path.isfile(ans):
+        # worktrees and submodules use a file pointing to the actual git dir
+        with open(ans, 'rb') as f:
+            raw = f.read().decode('utf-8', 'replace').strip()
+        if raw.startswith('gitdir:'):
+            ans = os.path.normpath(os.path.join(directory, raw.partition(':')[2].strip()))
+    return ans
+
+
+def git_watch(directory, tree):
+    tree.add_tree(directory)
+    gd = git_dir(directory)
+    dirs = [gd]
+    try:
+        with open(os.path.join(gd, 'commondir'), 'rb') as f:
+            dirs.append(os.path.normpath(os.path.join(gd, f.read().decode('utf-8', 'replace').strip())))
+    except OSError:
+        pass
+    for d in dirs:
+        tree.add_dir(d)
+        refs = os.path.join(d, 'refs')
+        if os.path.isdir(refs):
+            tree.add_tree(refs)
 # }}}
 
 
-def is_vcs(path):
+def find_vcs(path, visited, before=None):
     for directory in generate_directories(path):
+        if before is not None:
+            before(directory)
+        visited.append(directory)
         for vcs, vcs_dir, check, ignore_event in vcs_props:
             repo_dir = os.path.join(directory, vcs_dir)
             if check(repo_dir):
@@ -57,11 +153,135 @@ def is_vcs(path):
     return None, None, None
 
 
+# Map of directory to the result of find_vcs() for it, including negative
+# results, and the directories examined to get it. Every directory examined is
+# watched, and cached results are discarded when a VCS dir is created or
+# deleted in it, or it is removed/renamed. Only used if file system changes
+# are being watched. Cached results are published on the status board.
+repo_roots = {}
+repo_roots_watches = {}
+# Lookups in worker threads add to repo_roots_watches
+repo_roots_lock = threading.Lock()
+# Incremented whenever cached results are discarded, the results of lookups
+# that were in flight at the time are not cached, as they may be outdated
+repo_roots_epoch = 0
+MAX_REPO_ROOTS = 8192
+REPO_ROOT_EVENTS = (
+    inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO |
+    inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR
+)
+
+
+def clear_repo_roots():
+    global repo_roots_epoch
+    repo_roots_epoch += 1
+    for path in repo_roots:
+        board.dir_removed(path)
+    repo_roots.clear()
+    prune_repo_root_watches()
+
+
+def prune_repo_root_watches():
+    ' Remove the watches on directories that no cached result depends on '
+    global repo_roots_epoch
+    needed = set()
+    for ans, visited in repo_roots.values():
+        needed.update(visited)
+    with repo_roots_lock:
+        unneeded = [d for d in repo_roots_watches if d not in needed]
+        if unneeded:
+            # Lookups in flight may depend on the removed watches
+            repo_roots_epoch += 1
+            for directory in unneeded:
+                inotify.notifier.rm_watch(repo_roots_watches.pop(directory))
+
+
+def invalidate_repo_roots(prefix):
+    global repo_roots_epoch
+    repo_roots_epoch += 1
+    sprefix = prefix.rstrip(os.sep) + os.sep
+    for path in tuple(repo_roots):
+        if path == prefix or path.startswith(sprefix):
+            del repo_roots[path]
+            board.dir_removed(path)
+
+
+def repo_root_event(path, name, mask):
+    if not name:
+        # The directory itself was removed/renamed
+        invalidate_repo_roots(path)
+        with repo_roots_lock:
+            key = repo_roots_watches.pop(path, None)
+            if key is not None:
+                inotify.notifier.rm_watch(key)
+    elif name in vcs_dir_names:
+        invalidate_repo_roots(path)
+    elif mask & inotify.IN_ISDIR and mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO):
+        invalidate_repo_roots(os.path.join(path, name))
+
+
+def watch_repo_root_dir(directory):
+    with repo_roots_lock:
+        if directory not in repo_roots_watches:
+            repo_roots_watches[directory] = inotify.notifier.add_watch(directory, REPO_ROOT_EVENTS, repo_root_event)
+
+
+def find_repo_root(path):
+    ''' Return the result of find_vcs() for path, the directories examined
+    and whether they are all watched. Every directory is watched before it is
+    examined, so that no later change to it is missed. Safe to call in worker
+    threads. '''
+    visited = []
+    try:
+        return find_vcs(path, visited, watch_repo_root_dir), visited, True
+    except OSError:
+        return find_vcs(path, []), (), False
+
+
+def cache_repo_root(path, result, epoch):
+    ans, visited, watched = result
+    # If path does not exist, visited is empty and there is nothing to watch
+    if watched and visited and epoch == repo_roots_epoch:
+        if len(repo_roots) >= MAX_REPO_ROOTS:
+            clear_repo_roots()
+        repo_roots[path] = ans, tuple(visited)
+        board.dir_resolved(path, ans[1])
+    return ans
+
+
+def is_vcs(path):
+    if inotify.notifier is None:
+        return find_vcs(path, [])
+    x = repo_roots.get(path)
+    if x is None:
+        increment('repo_root_cache_misses')
+        return cache_repo_root(path, find_repo_root(path), repo_roots_epoch)
+    increment('repo_root_cache_hits')
+    return x[0]
+
+
+def resolve_repo_roots(paths):
+    ''' Return a Future that completes once the repository roots of all the
+    specified paths are cached, looking up the ones that are not in worker
+    threads, so that is_vcs() does not block for them. '''
+    futures = []
+    if inotify.notifier is not None:
+        for path in paths:
+            path = realpath(path)
+            if path not in repo_roots:
+                increment('repo_root_cache_misses')
+                # Lookups that started before an invalidation must not be shared
+                key = 'repo_root', path, repo_roots_epoch
+                futures.append(chain_future(run_blocking(key, find_repo_root, path), partial(cache_repo_root, path, epoch=repo_roots_epoch)))
+    return gather_futures(futures)
+
+
 vcs_props = (
     ('git', '.git', os.path.exists, git_ignore_modified),
     # ('mercurial', '.hg', os.path.isdir, None),
     # ('bzr', '.bzr', os.path.isdir, None),
 )
+vcs_dir_names = frozenset(x[1] for x in vcs_props)
 
 
 def escape_branch_name(name):
@@ -71,45 +291,228 @@ def escape_branch_name(name):
     return re.sub(r'[^a-zA-Z0-9_-]', '_', name)
 
 
-class VCSWatcher:
+class VCSWatcher(TreeWatcher):
+
+    # Number of updates sent to gitstatusd and of requests that shared one
+    # already in flight instead
+    updates = coalesced_updates = 0
+    # Directories ignored by git, such as build artifacts and virtualenvs
+    # are watched too, so large repositories can hit the limit on the number
+    # of directories. They are then always re-queried.
+    prune = staticmethod(git_prune)
 
     def __init__(self, path, vcs, ignore_event):
-        self.path = path
+        TreeWatcher.__init__(self, path)
         self.vcs = vcs
         self.ignore_event = ignore_event
         self.branch_name = None
         self.repo_status = None
-        self.file_status = {}
+        # Map of path to status for all files that are not clean, created on demand
+        self.status_map = None
+        # Incremented for every relevant change in the tree
+        self.generation = 0
+        # The generation the current data was fetched at
+        self.updated_generation = -1
+        # The (generation, Future) of the update in flight, if any
+        self.pending_update = None
+        self.start_watching()
+
+    def walk(self, tree_watch):
+        if self.vcs == 'git':
+            git_watch(self.path, tree_watch)
+
+    def watches_added(self, fut):
+        TreeWatcher.watches_added(self, fut)
+        # Changes made while the tree was being walked may have been missed,
+        # so data fetched before now is not current
+        self.changed()
+
+    def stop_watching(self):
+        TreeWatcher.stop_watching(self)
+        board.repo_removed(self.path)
+
+    @property
+    def is_current(self):
+        return self.updated_generation == self.generation and self.is_watched
+
+    def tree_changed(self, path, name, mask):
+        if self.ignore_event is None or not self.ignore_event(path, name):
+            self.changed()
+
+    def changed(self):
+        self.generation += 1
+        board.repo_changed(self.path)
+        listeners = change_listeners.get(self.path)
+        if listeners:
+            for listener in tuple(listeners):
+                listener()
 
     def data(self, subpath=None, both=False):
-        self.update(subpath, both)
-        return {'branch': self.branch_name, 'repo_status': self.repo_status, 'file_status': self.file_status.get(subpath)}
+        return self.data_batch((subpath,))[0]
 
-    def update(self, subpath=None, both=False):
-        self.vcs, self.path, self.ignore_event = is_vcs(self.path)
-        self.file_status = {}  # All saved file statuses are outdated
-        if self.vcs == 'git':
-            bn, self.repo_status = git_data(self.path)
-            self.branch_name = escape_branch_name(bn)
-            if subpath:
-                self.file_status[subpath] = git_file_status(self.path, subpath)
-        else:
+    def data_batch(self, subpaths):
+        if not self.is_current:
+            self.update()
+        return self.current_data(subpaths)
+
+    def data_batch_async(self, subpaths):
+        if self.is_current:
+            increment('vcs_data_hits')
+            return self.current_data_async(subpaths)
+        increment('vcs_data_misses')
+        return chain_future(self.update_async(), lambda x: self.current_data_async(subpaths))
+
+    def current_data(self, subpaths, status_map=None):
+        if status_map is None:
+            if self.status_map is None and any(subpaths):
+                self.status_map = git_status_map(self.path) if self.vcs == 'git' else {}
+            status_map = self.status_map
+        return [{
+            'branch': self.branch_name, 'repo_status': self.repo_status,
+            'file_status': status_for(status_map, s) if s else None} for s in subpaths]
+
+    def current_data_async(self, subpaths):
+        ' Like current_data() but runs git status, if needed, in a worker thread '
+        if self.status_map is None and any(subpaths) and self.vcs == 'git':
+            generation = self.updated_generation
+            return chain_future(
+                run_blocking(('status_map', self.path, generation), git_status_map, self.path),
+                partial(self.status_map_ready, generation, subpaths))
+        return resolved_future(self.current_data(subpaths))
+
+    def status_map_ready(self, generation, subpaths, status_map):
+        if generation == self.updated_generation:
+            self.status_map = status_map
+        return self.current_data(subpaths, status_map)
+
+    def start_update(self):
+        self.vcs, path, self.ignore_event = is_vcs(self.path)
+        if path != self.path:
+            self.vcs = None  # No longer the root of a repository
+        return self.generation
+
+    def finish_update(self, generation, git_data=None):
+        if generation < self.updated_generation:
+            return  # a later update has already finished
+        self.updated_generation = generation
+        self.status_map = None  # All saved file statuses are outdated
+        if git_data is None:
             self.branch_name = self.repo_status = None
+            board.repo_removed(self.path)
+        else:
+            bn, self.repo_status = git_data
+            self.branch_name = escape_branch_name(bn)
+            # Only data that is kept current by watching the tree can be
+            # trusted by readers of the board
+            board.repo_updated(self.path, self.branch_name, self.repo_status, self.is_current)
 
+    def update(self):
+        generation = self.start_update()
+        self.finish_update(generation, git_data(self.path) if self.vcs == 'git' else None)
 
-watched_trees = {}
+    def update_async(self):
+        ''' Like update() but returns a Future instead of blocking, for use in
+        an event loop that calls gsd.read_responses(). Requests made while an
+        update for the current generation is in flight share it. '''
+        if self.pending_update is not None and self.pending_update[0] == self.generation:
+            VCSWatcher.coalesced_updates += 1
+            return self.pending_update[1]
+        generation = self.start_update()
+        if self.vcs != 'git':
+            return resolved_future(self.finish_update(generation))
+        VCSWatcher.updates += 1
+        ans = chain_future(git_data_async(self.path), partial(self.finish_update, generation))
+        if not ans.done():
+            self.pending_update = generation, ans
+            ans.add_done_callback(self.update_done)
+        return ans
 
+    def update_done(self, fut):
+        if self.pending_update is not None and self.pending_update[1] is fut:
+            self.pending_update = None
 
-def vcs_data(path, subpath=None, both=False):
+
+# Map of repository root to the set of callables that are called whenever the
+# watcher for that repository sees a relevant change
+change_listeners = {}
+# Every tracked repository has a set of inotify watches, so limit how many
+# are kept around
+watched_trees = WatcherRegistry(max_size=64, max_idle=3600)
+
+
+def watcher_for(path, subpath=None):
+    ' Return the watcher for the repository containing path, and subpath relative to it '
     path = realpath(path)
     vcs, vcs_dir, ignore_event = is_vcs(path)
-    ans = {'branch': None, 'status': None}
-    if vcs:
-        if subpath and os.path.isabs(subpath):
-            subpath = os.path.relpath(subpath, vcs_dir)
-        w = watched_trees.get(vcs_dir)
-        if w is None:
-            watched_trees[path] = w = VCSWatcher(vcs_dir, vcs, ignore_event)
-        if w is not None:
-            ans = w.data(subpath, both)
+    if not vcs:
+        return None, subpath
+    if subpath and os.path.isabs(subpath):
+        subpath = os.path.relpath(subpath, vcs_dir)
+    w = watched_trees.get(vcs_dir)
+    if w is None:
+        w = watched_trees.add(vcs_dir, VCSWatcher(vcs_dir, vcs, ignore_event))
+    return w, subpath
+
+
+def stats():
+    return {
+        'watched_trees': len(watched_trees),
+        'watched_trees_evicted': watched_trees.evicted,
+        'repo_roots_cached': len(repo_roots),
+        'vcs_updates': VCSWatcher.updates,
+        'vcs_updates_coalesced': VCSWatcher.coalesced_updates,
+    }
+
+
+def vcs_data(path, subpath=None, both=False):
+    w, subpath = watcher_for(path, subpath)
+    if w is None:
+        return {'branch': None, 'status': None}
+    return w.data(subpath, both)
+
+
+def vcs_data_async(path, subpath=None, both=False):
+    w, subpath = watcher_for(path, subpath)
+    if w is None:
+        return resolved_future({'branch': None, 'status': None})
+    return chain_future(w.data_batch_async((subpath,)), lambda x: x[0])
+
+
+def prewarm(path):
+    ''' Find the repository containing path and start updating its data in
+    the background, without waiting for the result, so that queries made soon
+    after find it ready. '''
+    w = watcher_for(path)[0]
+    if w is not None and not w.is_current:
+        w.update_async().add_done_callback(report_failed_update)
+    return w
+
+
+def report_failed_update(fut):
+    err = fut.exception()
+    if err is not None:
+        print_error('Failed to update VCS data with error:', err)
+
+
+def group_queries(queries):
+    groups = {}
+    for i, (path, subpath) in enumerate(queries):
+        w, subpath = watcher_for(path, subpath)
+        groups.setdefault(w, []).append((i, subpath))
+    return groups
+
+
+def merge_groups(num, groups, results):
+    ans = [None] * num
+    for (w, items), data in zip(groups.items(), results):
+        for (i, subpath), x in zip(items, data):
+            ans[i] = x
     return ans
+
+
+def vcs_data_batch_async(queries):
+    groups = group_queries(queries)
+    futures = (
+        (w.data_batch_async(tuple(s for i, s in items)) if w is not None else resolved_future([{'branch': None, 'status': None}] * len(items)))
+        for w, items in groups.items())
+    return chain_future(gather_futures(futures), partial(merge_groups, len(queries), groups))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, SimpleQueue
+
+from .utils import resolved_future
+
+# Set by the server to a WorkerPool instance, when it is None, blocking work
+# is done in the calling thread
+pool = None
+
+
+class WorkerPool:
+
+    ''' Run blocking functions, such as subprocesses and file system walks, in
+    a bounded pool of threads. The returned Futures are completed in the thread
+    that calls process_results(), which the event loop does when fileno()
+    becomes readable, so their callbacks never run in the worker threads.
+    Submissions with the same key as a computation that is still running
+    share its Future. '''
+
+    def __init__(self, max_workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='watcher-worker')
+        self.read_fd, self.write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.results = SimpleQueue()
+        self.in_flight = {}
+        self.submitted = self.coalesced = 0
+
+    def fileno(self):
+        return self.read_fd
+
+    def submit(self, key, func, *args):
+        if key is not None:
+            fut = self.in_flight.get(key)
+            if fut is not None:
+                self.coalesced += 1
+                return fut
+        fut = Future()
+        if key is not None:
+            self.in_flight[key] = fut
+        self.submitted += 1
+        self.executor.submit(self.run, key, fut, func, args)
+        return fut
+
+    def run(self, key, fut, func, args):
+        # Called in a worker thread
+        try:
+            self.results.put((key, fut, func(*args), None))
+        except Exception as err:
+            self.results.put((key, fut, None, err))
+        try:
+            os.write(self.write_fd, b'\0')
+        except BlockingIOError:
+            pass  # the pipe is full, so a wakeup is pending anyway
+
+    def process_results(self):
+        # Drain the pipe first, so that a result queued after the queue is
+        # drained always causes another wakeup
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while True:
+            try:
+                key, fut, result, err = self.results.get_nowait()
+            except Empty:
+                break
+            if key is not None and self.in_flight.get(key) is fut:
+                del self.in_flight[key]
+            if err is None:
+                fut.set_result(result)
+            else:
+                fut.set_exception(err)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        os.close(self.read_fd), os.close(self.write_fd)
+
+
+def run_blocking(key, func, *args):
+    ''' Return a Future for the result of func(*args), run in the worker pool
+    if there is one. key identifies the computation for coalescing, use None
+    to not coalesce. '''
+    if pool is None:
+        try:
+            return resolved_future(func(*args))
+        except Exception as err:
+            ans = Future()
+            ans.set_exception(err)
+            return ans
+    return pool.submit(key, func, *args)
+
+
+def stats():
+    return {
+        'worker_jobs': 0 if pool is None else pool.submitted,
+        'worker_jobs_coalesced': 0 if pool is None else pool.coalesced,
+    }